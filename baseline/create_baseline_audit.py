@@ -7,10 +7,22 @@
 
 
 import argparse
+import bz2
+import collections
+import concurrent.futures
 import datetime
+import fnmatch
+import gzip
+import hashlib
+import io
+import json
+import lzma
 import os
 import re
 import sys
+import tarfile
+import time
+import zipfile
 
 import xml.etree.ElementTree as ET
 
@@ -27,8 +39,29 @@ regexes = {
 }
 
 no_value = '__ObNoXiOuS_StRiNg_ThAt_ShOuLd_NoT_ExIsT__'
+
+compressions = {
+    'gzip': b'\x1f\x8b',
+    'bz2': b'BZh',
+    'xz': b'\xfd7zXZ\x00',
+    'zip': b'PK\x03\x04'
+}
+
+archive_modes = [
+    ('.tar.gz', 'w:gz'),
+    ('.tgz', 'w:gz'),
+    ('.tar.bz2', 'w:bz2'),
+    ('.tar.xz', 'w:xz'),
+    ('.tar', 'w')
+]
+
+index_suffix = '.idx.json'
+index_version = 1
+shard_size = 32 * 1024 * 1024
+
 show_verbose = False
 show_time = False
+worker_template = None
 
 
 def parse_args(parameters):
@@ -46,8 +79,20 @@ def parse_args(parameters):
 
     parser.add_argument('-o', '--overwrite', action='store_true',
                         help='overwrite output file if it exists')
+    parser.add_argument('-c', '--consensus', action='store_true',
+                        help='create one audit from the most common value of each check across hosts')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='share of hosts that must agree on a consensus value, from 0 to 1')
+    parser.add_argument('-d', '--dedupe', action='store_true',
+                        help='create one audit per distinct set of values, with a manifest of hosts')
     parser.add_argument('-f', '--filename', nargs=1, default='',
                         help='override filename of output file')
+    parser.add_argument('-a', '--archive', type=str, default=None,
+                        help='write audits and manifest to a .zip, .tar, .tar.gz, .tar.bz2 or .tar.xz archive')
+    parser.add_argument('--host', type=str, action='append', default=None,
+                        help='only use hosts matching name or glob, or regex prefixed with re:')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of hosts to create audits for in parallel')
     parser.add_argument('-r', '--reference', nargs=1, default='',
                         help='add reference tag to identify deviations')
 
@@ -71,6 +116,21 @@ def parse_args(parameters):
     if not args.reference == '' and not regexes['ref_arg'].match(args.reference):
         display('Invalid reference parameter ([A-Za-z_-]+): {}'.format(args.reference), exit=1)
 
+    if args.jobs < 1:
+        display('Invalid number of jobs: {}'.format(args.jobs), exit=1)
+
+    if args.threshold is not None and not 0 < args.threshold <= 1:
+        display('Invalid threshold, must be above 0 and up to 1: {}'.format(args.threshold), exit=1)
+
+    if args.threshold is not None and not args.consensus:
+        display('The threshold can only be used with consensus', exit=1)
+
+    if args.archive is not None and get_archive_mode(args.archive) is None:
+        display('Unknown archive type: {}'.format(args.archive), exit=1)
+
+    if args.consensus and args.dedupe:
+        display('Consensus and dedupe can not be used together', exit=1)
+
     return args
 
 
@@ -104,11 +164,41 @@ def display(message, verbose=False, exit=0):
         sys.exit(exit)
 
 
+def get_compression(fin):
+    magic = fin.peek(8)[:8]
+    for compression in compressions:
+        if magic.startswith(compressions[compression]):
+            return compression
+    return None
+
+
+def open_input(filename):
+    fin = open(filename, 'rb')
+    compression = get_compression(fin)
+
+    if compression == 'gzip':
+        return gzip.open(fin)
+    elif compression == 'bz2':
+        return bz2.open(fin)
+    elif compression == 'xz':
+        return lzma.open(fin)
+    elif compression == 'zip':
+        archive = zipfile.ZipFile(fin)
+        names = [n for n in archive.namelist() if n.lower().endswith('.nessus')]
+        if not names:
+            names = [n for n in archive.namelist() if not n.endswith('/')]
+        if not names:
+            raise Exception('No files found in zip archive: {}'.format(filename))
+        return archive.open(names[0])
+
+    return fin
+
+
 def read_file(filename):
     contents = ''
     try:
         display('Reading {}'.format(filename), verbose=True)
-        with open(filename, 'r') as file_in:
+        with io.TextIOWrapper(open_input(filename)) as file_in:
             contents = file_in.read()
     except Exception as e:
         display('ERROR: reading file: {}: {}'.format(filename, e), exit=1)
@@ -116,6 +206,44 @@ def read_file(filename):
     return contents
 
 
+def get_archive_mode(filename):
+    if filename.lower().endswith('.zip'):
+        return 'zip'
+    for (extension, mode) in archive_modes:
+        if filename.lower().endswith(extension):
+            return mode
+    return None
+
+
+def open_archive(filename, overwrite=False):
+    if os.path.isfile(filename) and not overwrite:
+        display('ERROR: file exists: {}'.format(filename), exit=1)
+
+    try:
+        display('Writing {}'.format(filename), verbose=True)
+        mode = get_archive_mode(filename)
+        if mode == 'zip':
+            return zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+        return tarfile.open(filename, mode)
+    except Exception as e:
+        display('ERROR: writing file: {}: {}'.format(filename, e), exit=1)
+
+
+def write_archive_file(archive, filename, content):
+    try:
+        display('Adding {}'.format(filename), verbose=True)
+        data = content.encode('utf-8')
+        if isinstance(archive, zipfile.ZipFile):
+            archive.writestr(filename, data)
+        else:
+            info = tarfile.TarInfo(filename)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            archive.addfile(info, io.BytesIO(data))
+    except Exception as e:
+        display('ERROR: writing archive: {}: {}'.format(filename, e), exit=1)
+
+
 def write_file(filename, content, overwrite=False):
     if os.path.isfile(filename) and not overwrite:
         display('ERROR: file exists: {}'.format(filename), exit=1)
@@ -129,22 +257,54 @@ def write_file(filename, content, overwrite=False):
 
 
 def get_values_from_nessus(contents):
+    return dict(iter_values_from_nessus(io.StringIO(contents)))
+
+
+def make_host_pattern(pattern):
+    if pattern.startswith('re:'):
+        return re.compile(pattern[3:])
+    return re.compile(fnmatch.translate(pattern))
+
+
+def match_host(name, patterns):
+    if patterns is None:
+        return True
+    if name is None:
+        return False
+    for pattern in patterns:
+        if pattern.match(name):
+            return True
+    return False
+
+
+def iter_values_from_nessus(source, hosts=None):
     global no_value
-    values = {}
 
     try:
-        tree = ET.fromstring(contents)
-        for report in tree.findall('Report'):
-            for host in report.findall('ReportHost'):
-                hostname = host.attrib['name']
-                display('Retrieving values from {}'.format(hostname),
-                        verbose=True)
-                values[hostname] = {}
-                for item in host.findall('ReportItem'):
+        report_elem = None
+        hostname = None
+        host_values = None
+
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == 'Report':
+                    report_elem = elem
+                elif elem.tag == 'ReportHost':
+                    hostname = elem.attrib['name']
+                    # items of a skipped host are cleared without being read
+                    if not match_host(hostname, hosts):
+                        display('Skipping host {}'.format(hostname), verbose=True)
+                        continue
+                    display('Retrieving values from {}'.format(hostname),
+                            verbose=True)
+                    host_values = {}
+
+            elif elem.tag == 'ReportItem':
+                if host_values is not None:
                     description = ''
                     value = no_value
                     result = no_value
-                    for child in item:
+                    for child in elem:
                         if 'compliance-check-name' in child.tag:
                             description = child.text.strip()
                         elif 'compliance-actual-value' in child.tag:
@@ -152,12 +312,89 @@ def get_values_from_nessus(contents):
                         if 'compliance-result' in child.tag:
                             result = child.text.strip()
                     if description and value != no_value and result != no_value:
-                        values[hostname][description] = (value, result)
+                        host_values[description] = (value, result)
+                # only the captured values are kept, not the item
+                elem.clear()
+
+            elif elem.tag == 'ReportHost':
+                if host_values is not None:
+                    yield (hostname, host_values)
+                host_values = None
+                elem.clear()
+                if report_elem is not None:
+                    report_elem.remove(elem)
+
+            elif elem.tag == 'Policy':
+                elem.clear()
     except Exception as e:
         display('ERROR: parsing nessus file: {}'.format(e), exit=1)
         sys.exit(1)
 
-    return values
+
+def load_host_index(filename):
+    # the index written by nessus_convert.py index, while it matches the file
+    index_file = filename + index_suffix
+    if not os.path.isfile(index_file):
+        return None
+
+    try:
+        with open(filename, 'rb') as file_in:
+            if get_compression(file_in) is not None:
+                return None
+        stat = os.stat(filename)
+        with open(index_file, 'r') as file_in:
+            index = json.load(file_in)
+    except Exception as e:
+        display('Unable to read host index {}: {}'.format(index_file, e), verbose=True)
+        return None
+
+    if (index.get('version') != index_version or index.get('size') != stat.st_size or
+            index.get('mtime') != stat.st_mtime):
+        display('Host index is out of date: {}'.format(index_file), verbose=True)
+        return None
+
+    display('Using host index {}'.format(index_file), verbose=True)
+    return index
+
+
+def iter_indexed_hosts(filename, index, hosts):
+    spans = []
+    for host in index['hosts']:
+        if not match_host(host.get('name'), hosts):
+            continue
+        end = host['offset'] + host['length']
+        if spans and spans[-1][1] == host['offset'] and end - spans[-1][0] <= shard_size:
+            spans[-1][1] = end
+        else:
+            spans.append([host['offset'], end])
+
+    # the Policy and Report context wraps the hosts so they parse standalone
+    with open(filename, 'rb') as file_in:
+        header = file_in.read(index['header_end'])
+        file_in.seek(index['report_end'])
+        footer = file_in.read()
+        for (start, end) in spans:
+            file_in.seek(start)
+            yield io.BytesIO(header + file_in.read(end - start) + footer)
+
+
+def iter_values(filename, hosts=None):
+    try:
+        display('Reading {}'.format(filename), verbose=True)
+        index = None
+        if hosts is not None:
+            index = load_host_index(filename)
+        if index is not None:
+            # only the byte ranges of matching hosts are read
+            for shard in iter_indexed_hosts(filename, index, hosts):
+                for host in iter_values_from_nessus(shard, hosts):
+                    yield host
+        else:
+            with open_input(filename) as file_in:
+                for host in iter_values_from_nessus(file_in, hosts):
+                    yield host
+    except Exception as e:
+        display('ERROR: reading file: {}: {}'.format(filename, e), exit=1)
 
 
 def create_filename(filename, hostname):
@@ -166,6 +403,11 @@ def create_filename(filename, hostname):
     return '{}.{}.{}'.format(basefile, hostname, ext)
 
 
+def create_manifest_filename(filename):
+    basefile = '.'.join(filename.split('.')[:-1])
+    return '{}.manifest.json'.format(basefile)
+
+
 def strip_quotes(target):
     if isinstance(target, str):
         stripped = target.strip()
@@ -206,79 +448,268 @@ def quote_and_escape_value(source, plugin):
     return value
 
 
-def apply_values_to_audit(filename, contents, values, reference=''):
+def index_audit(contents):
     global regexes
 
-    audits = {}
-
-    plugin = get_plugin_from_contents(contents)
+    template = {
+        'contents': contents,
+        'plugin': get_plugin_from_contents(contents),
+        'lines': [],
+        'events': [],
+        'descriptions': {}
+    }
 
     lines = contents.split('\n')
-    for host in values:
-        display('Applying values for {}'.format(host), verbose=True)
-        auditname = create_filename(filename, host)
-        audit_lines = []
-        in_condition = False
-        in_item = False
-        found_ref = False
-        result = None
-        known_good = ''
-        space = ''
-
-        for line in lines:
-            if regexes['econ'].match(line):
-                in_condition = False
-
-            elif regexes['scon'].match(line):
-                in_condition = True
-
-            elif regexes['sitem'].match(line):
-                in_item = True
-                found_ref = False
-
-            elif regexes['eitem'].match(line):
-                if not reference == '' and not found_ref:
-                    value = format_reference(result, reference)
-                    new_line = '{}reference : "{}"'.format(space, value)
-                    audit_lines.append(new_line)
-                if not known_good == '':
-                    value = quote_and_escape_value(known_good, plugin)
-                    new_line = '{}known_good : {}'.format(space, value)
-                    audit_lines.append(new_line)
-                known_good = ''
-                result = None
-                in_item = False
-
-            elif regexes['desc'].match(line):
-                description = ':'.join(line.split(':')[1:]).strip()
-                stripped = strip_quotes(description)
-
-                if stripped in values[host]:
-                    known_good = values[host][stripped][0]
-                    result = values[host][stripped][1]
-                    space = regexes['desc'].findall(line)[0]
-
-            elif not reference == '' and regexes['ref'].match(line):
-                elements = line.split('"')
-                current_refs = elements[1].split(',')
-                for x in range(len(current_refs)):
-                    parts = current_refs[x].strip().split('|')
-                    if parts[0] == reference:
-                        current_refs[x] = format_reference(result, reference)
-                        found_ref = True
-
-                if not found_ref:
-                    current_refs.append(format_reference(result, reference))
-
-                elements[1] = ','.join(current_refs)
-                line = '"'.join(elements)
-                found_ref = True
-
-            audit_lines.append(line)
-
-        audits[auditname] = '\n'.join(audit_lines)
-
-    return audits
+    offset = 0
+    eitems = 0
+    for (number, line) in enumerate(lines):
+        template['lines'].append((offset, line))
+        offset += len(line) + 1
+
+        if regexes['econ'].match(line) or regexes['scon'].match(line):
+            continue
+
+        elif regexes['sitem'].match(line):
+            template['events'].append(('sitem', number, None))
+
+        elif regexes['eitem'].match(line):
+            template['events'].append(('eitem', number, None))
+            eitems += 1
+
+        elif regexes['desc'].match(line):
+            description = ':'.join(line.split(':')[1:]).strip()
+            stripped = strip_quotes(description) if description else ''
+            space = regexes['desc'].findall(line)[0]
+            template['events'].append(('desc', number, (stripped, space)))
+            # the item end that a description applies to, by order of item ends
+            template['descriptions'].setdefault(stripped, []).append(
+                (len(template['events']), eitems, space))
+
+        elif regexes['ref'].match(line):
+            template['events'].append(('ref', number, None))
+
+    template['eitems'] = [e[1] for e in template['events'] if e[0] == 'eitem']
+
+    return template
+
+
+def render_audit(template, values, reference=''):
+    if not reference == '':
+        return render_audit_with_reference(template, values, reference)
+
+    # only the last matched description before each item end is used
+    matched = {}
+    for description in values:
+        for (order, eitem, space) in template['descriptions'].get(description, ()):
+            if eitem < len(template['eitems']):
+                if eitem not in matched or matched[eitem][0] < order:
+                    matched[eitem] = (order, description, space)
+
+    splices = []
+    for eitem in sorted(matched):
+        (order, description, space) = matched[eitem]
+        known_good = values[description][0]
+        if not known_good == '':
+            value = quote_and_escape_value(known_good, template['plugin'])
+            new_line = '{}known_good : {}'.format(space, value)
+            splices.append((template['eitems'][eitem], [new_line], False))
+
+    return splice_audit(template, splices)
+
+
+def render_audit_with_reference(template, values, reference):
+    splices = []
+    found_ref = False
+    result = None
+    known_good = ''
+    space = ''
+
+    for (kind, number, data) in template['events']:
+        if kind == 'sitem':
+            found_ref = False
+
+        elif kind == 'eitem':
+            new_lines = []
+            if not found_ref:
+                value = format_reference(result, reference)
+                new_lines.append('{}reference : "{}"'.format(space, value))
+            if not known_good == '':
+                value = quote_and_escape_value(known_good, template['plugin'])
+                new_lines.append('{}known_good : {}'.format(space, value))
+            splices.append((number, new_lines, False))
+            known_good = ''
+            result = None
+
+        elif kind == 'desc':
+            if data[0] in values:
+                (known_good, result) = values[data[0]]
+                space = data[1]
+
+        elif kind == 'ref':
+            line = template['lines'][number][1]
+            new_line = replace_reference(line, result, reference, found_ref)
+            splices.append((number, [new_line], True))
+            found_ref = True
+
+    return splice_audit(template, splices)
+
+
+def replace_reference(line, result, reference, found_ref=False):
+    elements = line.split('"')
+    current_refs = elements[1].split(',')
+    for x in range(len(current_refs)):
+        parts = current_refs[x].strip().split('|')
+        if parts[0] == reference:
+            current_refs[x] = format_reference(result, reference)
+            found_ref = True
+
+    if not found_ref:
+        current_refs.append(format_reference(result, reference))
+
+    elements[1] = ','.join(current_refs)
+    return '"'.join(elements)
+
+
+def splice_audit(template, splices):
+    contents = template['contents']
+    parts = []
+    position = 0
+
+    # lines are inserted before a line, or replace it
+    for (number, new_lines, replace) in splices:
+        (offset, line) = template['lines'][number]
+        parts.append(contents[position:offset])
+        for new_line in new_lines:
+            parts.append(new_line)
+            parts.append('\n')
+        position = offset
+        if replace:
+            parts.pop()
+            position += len(line)
+    parts.append(contents[position:])
+
+    return ''.join(parts)
+
+
+def set_worker(template, timestamp, verbose):
+    global show_time, show_verbose, worker_template
+    show_time = timestamp
+    show_verbose = verbose
+    worker_template = template
+
+
+def render_host(host, values, reference=''):
+    global worker_template
+    display('Applying values for {}'.format(host), verbose=True)
+    return render_audit(worker_template, values, reference)
+
+
+def iter_audits(filename, contents, hosts, reference='', jobs=1):
+    template = index_audit(contents)
+
+    if jobs < 2:
+        for (host, values) in hosts:
+            display('Applying values for {}'.format(host), verbose=True)
+            yield (create_filename(filename, host), render_audit(template, values, reference))
+        return
+
+    # the template is sent to each worker once, and only host values after
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=set_worker,
+            initargs=(template, show_time, show_verbose)) as executor:
+        pending = collections.deque()
+        for (host, values) in hosts:
+            pending.append((host, executor.submit(render_host, host, values, reference)))
+            # bound the audits held in memory while keeping the workers busy
+            if len(pending) >= jobs * 2:
+                (host, future) = pending.popleft()
+                yield (create_filename(filename, host), future.result())
+
+        while pending:
+            (host, future) = pending.popleft()
+            yield (create_filename(filename, host), future.result())
+
+
+def get_fingerprint(values, reference=''):
+    # results only change the audit when a reference is added
+    digest = hashlib.sha1()
+    for description in sorted(values):
+        (value, result) = values[description]
+        fields = [description, value]
+        if not reference == '':
+            fields.append(result)
+        digest.update(json.dumps(fields).encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def record_hosts(hosts, manifest, label=None):
+    for (host, values) in hosts:
+        manifest[host] = label or host
+        yield (host, values)
+
+
+def dedupe_hosts(hosts, manifest, reference=''):
+    fingerprints = set()
+    for (host, values) in hosts:
+        label = get_fingerprint(values, reference)[:16]
+        if label in fingerprints:
+            display('Host {} has the same values as baseline {}'.format(host, label), verbose=True)
+        else:
+            fingerprints.add(label)
+            yield (label, values)
+        manifest[host] = label
+
+
+def count_values(hosts):
+    counters = {}
+    for (host, values) in hosts:
+        for description in values:
+            counters.setdefault(description, collections.Counter())[values[description]] += 1
+    return counters
+
+
+def get_consensus(counters, threshold=None):
+    consensus = {}
+    for description in counters:
+        counter = counters[description]
+        total = sum(counter.values())
+
+        # the results of a value are counted together to find the most common
+        value_counts = collections.Counter()
+        for ((value, result), count) in counter.items():
+            value_counts[value] += count
+        (value, count) = value_counts.most_common(1)[0]
+
+        if threshold is None:
+            agreed = count * 2 > total
+        else:
+            agreed = count >= threshold * total
+
+        if not agreed:
+            display('No consensus for {}: {} of {} hosts agree'.format(description, count, total),
+                    verbose=True)
+            continue
+
+        results = [(c, r) for ((v, r), c) in counter.items() if v == value]
+        consensus[description] = (value, max(results, key=lambda x: x[0])[1])
+
+    return consensus
+
+
+def find_outliers(hosts, consensus):
+    for (host, values) in hosts:
+        differs = [d for d in values if d in consensus and not values[d][0] == consensus[d][0]]
+        if differs:
+            yield (host, differs)
+
+
+def apply_values_to_audit(filename, contents, values, reference=''):
+    if not values:
+        return {}
+
+    return dict(iter_audits(filename, contents, values.items(), reference))
 
 
 def format_reference(result, reference):
@@ -290,27 +721,79 @@ def format_reference(result, reference):
     return '{}|{}'.format(reference, dev)
 
 
-def output_audits(audits, overwrite, output_file):
-    for filename in audits:
+def output_audits(audits, overwrite, output_file, archive=None):
+    for (filename, content) in audits:
         output_name = filename
 
         if output_file:
             output_name = output_file
 
-        write_file(output_name, audits[filename], overwrite)
+        if archive is not None:
+            write_archive_file(archive, os.path.basename(output_name), content)
+        else:
+            write_file(output_name, content, overwrite)
+
+
+def report_outliers(outliers):
+    count = 0
+    for (host, differs) in outliers:
+        count += 1
+        display('Outlier {}: {} checks differ from the consensus'.format(host, len(differs)))
+        for description in differs:
+            display('    {}'.format(description), verbose=True)
+    display('Found {} outlier hosts'.format(count))
+
+
+def output_manifest(manifest, overwrite, audit_file, output_file, archive=None):
+    hosts = {}
+    for host in manifest:
+        hosts[host] = output_file or create_filename(audit_file, manifest[host])
+        if archive is not None:
+            hosts[host] = os.path.basename(hosts[host])
+
+    display('Created {} audits for {} hosts'.format(len(set(hosts.values())), len(hosts)))
+    content = json.dumps(hosts, indent=2) + '\n'
+    if archive is not None:
+        write_archive_file(archive, os.path.basename(create_manifest_filename(audit_file)), content)
+    else:
+        write_file(create_manifest_filename(audit_file), content, overwrite)
 
 
 if __name__ == '__main__':
     args = parse_args(sys.argv[1:])
     display('Start')
-    display('Reading nessus file')
-    nessus = read_file(args.nessus)
-    display('Retrieving values')
-    values = get_values_from_nessus(nessus)
     display('Reading audit file')
     audit = read_file(args.audit)
-    display('Applying values')
-    outputs = apply_values_to_audit(args.audit, audit, values, args.reference)
-    display('Outputing file')
-    output_audits(outputs, args.overwrite, args.filename)
+    display('Applying values from nessus file')
+    hosts = None
+    if args.host:
+        hosts = [make_host_pattern(h) for h in args.host]
+    # each audit is written as soon as it is ready, so hosts are not held
+    values = iter_values(args.nessus, hosts)
+    manifest = None
+    if args.dedupe or args.archive is not None:
+        manifest = {}
+    if args.consensus:
+        if manifest is not None:
+            values = record_hosts(values, manifest, 'consensus')
+        # only counts of each value are kept, then hosts are compared again
+        consensus = get_consensus(count_values(values), args.threshold)
+        values = [('consensus', consensus)]
+    elif args.dedupe:
+        values = dedupe_hosts(values, manifest, args.reference)
+    elif manifest is not None:
+        values = record_hosts(values, manifest)
+    outputs = iter_audits(args.audit, audit, values, args.reference, args.jobs)
+    archive = None
+    if args.archive is not None:
+        archive = open_archive(args.archive, args.overwrite)
+    try:
+        output_audits(outputs, args.overwrite, args.filename, archive)
+        if manifest is not None:
+            output_manifest(manifest, args.overwrite, args.audit, args.filename, archive)
+    finally:
+        if archive is not None:
+            archive.close()
+    if args.consensus:
+        report_outliers(find_outliers(iter_values(args.nessus, hosts), consensus))
     display('Done')
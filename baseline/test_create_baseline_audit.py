@@ -1,14 +1,30 @@
 #!/usr/bin/env python3
 
+import io
 import pytest
 
 # importing testable functions
 from create_baseline_audit import parse_args
 from create_baseline_audit import make_list
+from create_baseline_audit import get_archive_mode
 from create_baseline_audit import create_filename
+from create_baseline_audit import create_manifest_filename
 from create_baseline_audit import strip_quotes
 from create_baseline_audit import get_values_from_nessus
+from create_baseline_audit import iter_values_from_nessus
+from create_baseline_audit import make_host_pattern
+from create_baseline_audit import match_host
 from create_baseline_audit import apply_values_to_audit
+from create_baseline_audit import iter_audits
+from create_baseline_audit import get_fingerprint
+from create_baseline_audit import record_hosts
+from create_baseline_audit import dedupe_hosts
+from create_baseline_audit import count_values
+from create_baseline_audit import get_consensus
+from create_baseline_audit import find_outliers
+from create_baseline_audit import index_audit
+from create_baseline_audit import render_audit
+from create_baseline_audit import replace_reference
 from create_baseline_audit import get_plugin_from_contents
 from create_baseline_audit import quote_and_escape_value
 from create_baseline_audit import format_reference
@@ -19,9 +35,17 @@ from create_baseline_audit import show_verbose
 
 # input/output methods are not tested
 #     display(message, verbose=False, exit=0):
+#     open_input(filename):
+#     open_archive(filename, overwrite=False):
+#     write_archive_file(archive, filename, content):
 #     read_file(filename):
+#     load_host_index(filename):
+#     iter_indexed_hosts(filename, index, hosts):
+#     iter_values(filename, hosts=None):
 #     write_file(filename, content, overwrite=False):
-#     output_audits(audits, overwrite, output_file):
+#     output_audits(audits, overwrite, output_file, archive=None):
+#     report_outliers(outliers):
+#     output_manifest(manifest, overwrite, audit_file, output_file, archive=None):
 
 
 test_items = [
@@ -73,6 +97,7 @@ def test_parse_args_defaults():
     assert args.verbose == False
     assert args.overwrite == False
     assert args.filename == ''
+    assert args.jobs == 1
     assert args.audit == 'test.audit'
     assert args.nessus == 'test.nessus'
 
@@ -80,16 +105,63 @@ def test_parse_args_defaults():
 def test_parse_args_all_values():
     from create_baseline_audit import show_time
     from create_baseline_audit import show_verbose
-    args = parse_args(['-t', '-v', '-o', '-f', 'output.audit',
+    args = parse_args(['-t', '-v', '-o', '-f', 'output.audit', '-j', '2',
                        'test.audit', 'test.nessus'])
     assert args.timestamp == True
     assert args.verbose == True
     assert args.overwrite == True
     assert args.filename == 'output.audit'
+    assert args.jobs == 2
     assert args.audit == 'test.audit'
     assert args.nessus == 'test.nessus'
 
 
+def test_parse_args_consensus(capsys):
+    args = parse_args(['-c', '--threshold', '0.8', 'test.audit', 'test.nessus'])
+    assert args.consensus == True
+    assert args.threshold == 0.8
+    for parameters in (['--threshold', '0.8'], ['-c', '--threshold', '0'], ['-c', '-d']):
+        with pytest.raises(SystemExit) as pytest_wrapped_e:
+            parse_args(parameters + ['test.audit', 'test.nessus'])
+        assert pytest_wrapped_e.type == SystemExit
+
+
+def test_parse_args_hosts():
+    args = parse_args(['--host', '192.168.0.*', '--host', 're:web[0-9]+', 'test.audit', 'test.nessus'])
+    assert args.host == ['192.168.0.*', 're:web[0-9]+']
+    assert parse_args(['test.audit', 'test.nessus']).host is None
+
+
+def test_match_host():
+    patterns = [make_host_pattern('192.168.0.1?'), make_host_pattern('re:web[0-9]+$')]
+    assert match_host('192.168.0.10', patterns)
+    assert match_host('web01', patterns)
+    assert not match_host('192.168.0.1', patterns)
+    assert not match_host('web01.example.com', patterns)
+    assert not match_host(None, patterns)
+    assert match_host('192.168.0.1', None)
+
+
+def test_parse_args_archive(capsys):
+    args = parse_args(['-a', 'baselines.tar.gz', 'test.audit', 'test.nessus'])
+    assert args.archive == 'baselines.tar.gz'
+    with pytest.raises(SystemExit) as pytest_wrapped_e:
+        parse_args(['-a', 'baselines.rar', 'test.audit', 'test.nessus'])
+    assert pytest_wrapped_e.type == SystemExit
+    (out, err) = capsys.readouterr()
+    assert 'Unknown archive type' in err
+
+
+def test_get_archive_mode():
+    assert get_archive_mode('a.zip') == 'zip'
+    assert get_archive_mode('a.tar') == 'w'
+    assert get_archive_mode('a.tar.gz') == 'w:gz'
+    assert get_archive_mode('A.TGZ') == 'w:gz'
+    assert get_archive_mode('a.tar.bz2') == 'w:bz2'
+    assert get_archive_mode('a.tar.xz') == 'w:xz'
+    assert get_archive_mode('a.audit') is None
+
+
 def test_make_list():
     assert make_list() == []
     assert make_list('abc') == ['abc']
@@ -109,6 +181,11 @@ def test_create_filename():
         assert create_filename(filename, host) == expected
 
 
+def test_create_manifest_filename():
+    assert create_manifest_filename('abc.audit') == 'abc.manifest.json'
+    assert create_manifest_filename('/tmp/x.y.audit') == '/tmp/x.y.manifest.json'
+
+
 def test_strip_quotes():
     tests = [
         ('abc', 'abc'),
@@ -195,6 +272,41 @@ def test_get_values_from_nessus_value_with_newline():
     }
 
 
+def test_iter_values_from_nessus_yields_each_host():
+    values = generate_test_content({
+        '192.168.0.10': (2,),
+        '192.168.0.11': (),
+        '192.168.0.12': (3, 4)
+    })
+    assert list(iter_values_from_nessus(io.StringIO(values))) == [
+        ('192.168.0.10', {
+            'Test value two': ('0', 'FAILED')
+        }),
+        ('192.168.0.11', {}),
+        ('192.168.0.12', {
+            'Test value three': ('This is\nmulti-line', 'PASSED'),
+            'Test value two for 2nd host': ('1', 'WARNING')
+        })
+    ]
+
+
+def test_iter_values_from_nessus_selected_hosts():
+    values = generate_test_content({
+        '192.168.0.10': (2,),
+        '192.168.0.11': (3,),
+        '192.168.0.12': (4,)
+    })
+    hosts = [make_host_pattern('192.168.0.1[02]')]
+    assert list(iter_values_from_nessus(io.StringIO(values), hosts)) == [
+        ('192.168.0.10', {
+            'Test value two': ('0', 'FAILED')
+        }),
+        ('192.168.0.12', {
+            'Test value two for 2nd host': ('1', 'WARNING')
+        })
+    ]
+
+
 def test_apply_values_to_audit_no_content_or_values():
     assert apply_values_to_audit('abc.audit', '', {}) == {}
 
@@ -408,6 +520,158 @@ def test_apply_values_to_audit_quoted_values():
         assert actual == expected
 
 
+def test_iter_audits_in_parallel():
+    test_content = ('<check_type:"Unix">\n'
+                    '<custom_item>\n'
+                    '  description: "Test value one"\n'
+                    '</custom_item>\n'
+                    '</check_type>')
+    hosts = [('192.168.0.{}'.format(i), { 'Test value one': (str(i), 'PASSED') })
+             for i in range(10)]
+    expected = list(iter_audits('abc.audit', test_content, hosts, 'ABC'))
+    assert [a[0] for a in expected] == ['abc.192.168.0.{}.audit'.format(i) for i in range(10)]
+    assert list(iter_audits('abc.audit', test_content, iter(hosts), 'ABC', jobs=2)) == expected
+
+
+def test_get_fingerprint():
+    one = { 'Test value one': ('0', 'PASSED'), 'Test value two': ('1', 'FAILED') }
+    two = { 'Test value two': ('1', 'PASSED'), 'Test value one': ('0', 'PASSED') }
+    assert get_fingerprint(one) == get_fingerprint(two)
+    assert get_fingerprint(one, 'ABC') != get_fingerprint(two, 'ABC')
+    assert get_fingerprint(one) != get_fingerprint({ 'Test value one': ('0', 'PASSED') })
+    assert get_fingerprint({}) == get_fingerprint({})
+
+
+def test_record_hosts():
+    hosts = [
+        ('192.168.0.10', { 'Test value one': ('0', 'PASSED') }),
+        ('192.168.0.11', { 'Test value one': ('1', 'PASSED') })
+    ]
+    manifest = {}
+    assert list(record_hosts(hosts, manifest)) == hosts
+    assert manifest == { '192.168.0.10': '192.168.0.10', '192.168.0.11': '192.168.0.11' }
+    manifest = {}
+    assert list(record_hosts(hosts, manifest, 'consensus')) == hosts
+    assert manifest == { '192.168.0.10': 'consensus', '192.168.0.11': 'consensus' }
+
+
+def test_dedupe_hosts():
+    hosts = [
+        ('192.168.0.10', { 'Test value one': ('0', 'PASSED') }),
+        ('192.168.0.11', { 'Test value one': ('1', 'PASSED') }),
+        ('192.168.0.12', { 'Test value one': ('0', 'PASSED') })
+    ]
+    manifest = {}
+    deduped = list(dedupe_hosts(hosts, manifest))
+    assert [d[1] for d in deduped] == [hosts[0][1], hosts[1][1]]
+    assert manifest == {
+        '192.168.0.10': deduped[0][0],
+        '192.168.0.11': deduped[1][0],
+        '192.168.0.12': deduped[0][0]
+    }
+
+
+def test_count_values_and_get_consensus():
+    hosts = [
+        ('192.168.0.10', { 'Test value one': ('0', 'PASSED'), 'Test value two': ('a', 'PASSED') }),
+        ('192.168.0.11', { 'Test value one': ('0', 'FAILED'), 'Test value two': ('b', 'FAILED') }),
+        ('192.168.0.12', { 'Test value one': ('0', 'FAILED'), 'Test value two': ('c', 'FAILED') }),
+        ('192.168.0.13', { 'Test value one': ('1', 'PASSED') })
+    ]
+    counters = count_values(iter(hosts))
+    assert counters['Test value one'] == {('0', 'PASSED'): 1, ('0', 'FAILED'): 2, ('1', 'PASSED'): 1}
+    assert get_consensus(counters) == { 'Test value one': ('0', 'FAILED') }
+    assert get_consensus(counters, 0.8) == {}
+    assert get_consensus(counters, 0.3) == {
+        'Test value one': ('0', 'FAILED'),
+        'Test value two': ('a', 'PASSED')
+    }
+
+
+def test_find_outliers():
+    hosts = [
+        ('192.168.0.10', { 'Test value one': ('0', 'PASSED'), 'Test value two': ('a', 'PASSED') }),
+        ('192.168.0.11', { 'Test value one': ('1', 'FAILED'), 'Test value two': ('a', 'FAILED') }),
+        ('192.168.0.12', { 'Test value three': ('1', 'PASSED') })
+    ]
+    consensus = { 'Test value one': ('0', 'PASSED'), 'Test value two': ('a', 'PASSED') }
+    assert list(find_outliers(hosts, consensus)) == [('192.168.0.11', ['Test value one'])]
+
+
+def test_index_audit():
+    test_content = ('<check_type:"Unix">\n'
+                    '<condition type:"and">\n'
+                    '<custom_item>\n'
+                    '  description: "Test value one"\n'
+                    '</custom_item>\n'
+                    '</condition>\n'
+                    '<custom_item>\n'
+                    '  description: \'Test value two\'\n'
+                    '  reference : "800-53|CM-7"\n'
+                    '</custom_item>\n'
+                    '</check_type>')
+    template = index_audit(test_content)
+    assert template['plugin'] == 'Unix'
+    assert template['events'] == [
+        ('sitem', 2, None),
+        ('desc', 3, ('Test value one', '  ')),
+        ('eitem', 4, None),
+        ('sitem', 6, None),
+        ('desc', 7, ('Test value two', '  ')),
+        ('ref', 8, None),
+        ('eitem', 9, None)
+    ]
+    assert template['eitems'] == [4, 9]
+    assert template['descriptions'] == {
+        'Test value one': [(2, 0, '  ')],
+        'Test value two': [(5, 1, '  ')]
+    }
+
+
+def test_render_audit_reuses_template():
+    test_content = ('<check_type:"Unix">\n'
+                    '<custom_item>\n'
+                    '  description: "Test value one"\n'
+                    '</custom_item>\n'
+                    '<custom_item>\n'
+                    '  description: "Test value two"\n'
+                    '  reference : "800-53|CM-7"\n'
+                    '</custom_item>\n'
+                    '</check_type>')
+    template = index_audit(test_content)
+    assert render_audit(template, {'Test value two': ('1', 'FAILED')}) == (
+        '<check_type:"Unix">\n'
+        '<custom_item>\n'
+        '  description: "Test value one"\n'
+        '</custom_item>\n'
+        '<custom_item>\n'
+        '  description: "Test value two"\n'
+        '  reference : "800-53|CM-7"\n'
+        '  known_good : "1"\n'
+        '</custom_item>\n'
+        '</check_type>')
+    assert render_audit(template, {'Test value one': ('0', 'PASSED')}, 'ABC') == (
+        '<check_type:"Unix">\n'
+        '<custom_item>\n'
+        '  description: "Test value one"\n'
+        '  reference : "ABC|compliant"\n'
+        '  known_good : "0"\n'
+        '</custom_item>\n'
+        '<custom_item>\n'
+        '  description: "Test value two"\n'
+        '  reference : "800-53|CM-7,ABC|review"\n'
+        '</custom_item>\n'
+        '</check_type>')
+    assert render_audit(template, {}) == test_content
+
+
+def test_replace_reference():
+    line = '  reference : "800-53|CM-7,ABC|review"'
+    assert replace_reference(line, 'FAILED', 'ABC') == '  reference : "800-53|CM-7,ABC|deviation"'
+    assert replace_reference(line, 'PASSED', 'XYZ') == '  reference : "800-53|CM-7,ABC|review,XYZ|compliant"'
+    assert replace_reference(line, 'PASSED', 'XYZ', True) == line
+
+
 def test_format_reference():
     assert format_reference('PASSED', 'a') == 'a|compliant'
     assert format_reference('WARNING', 'b') == 'b|review'
@@ -4,18 +4,96 @@
 #               output in specified format.
 
 import argparse
+import bz2
+import collections
+import collections.abc
+import concurrent.futures
 import csv
 import datetime
+import fnmatch
+import functools
+import gzip
+import hashlib
+import io
 import json
+import lzma
 import os
+import re
+import sqlite3
 import sys
+import time
+import zipfile
 
 import xml.etree.ElementTree as ET
 
 show_verbose = False
 show_time = False
+show_stderr = False
+last_error = None
 
-formats = [ 'csv', 'json' ]
+formats = [ 'csv', 'json', 'jsonl', 'sqlite' ]
+
+compressions = {
+    'gzip': (b'\x1f\x8b', '.gz'),
+    'bz2': (b'BZh', '.bz2'),
+    'xz': (b'\xfd7zXZ\x00', '.xz'),
+    'zip': (b'PK\x03\x04', '.zip')
+}
+
+field_regex = re.compile(b'<cm:compliance-([A-Za-z0-9_-]+)[ \t>]')
+scan_size = 1024 * 1024
+shard_size = 32 * 1024 * 1024
+batch_size = 5000
+index_suffix = '.idx.json'
+index_version = 1
+
+host_columns = [ 'report', 'target', 'host_ip', 'host_fqdn', 'start', 'end' ]
+
+compliance_fields = [
+    'target',
+    'plugin_id',
+    'plugin_name',
+    'result',
+    'check_name',
+    'info',
+    'solution',
+    'see_also',
+    'reference',
+    'policy_value',
+    'actual_value',
+    'error',
+    'audit_file',
+    'benchmark_name',
+    'benchmark_version',
+    'benchmark_profile',
+    'check_id',
+    'control_id',
+    'full_id',
+    'functional_id',
+    'informational_id'
+]
+
+diff_fields = [
+    'target',
+    'change',
+    'check_name',
+    'old_result',
+    'result',
+    'old_actual_value',
+    'actual_value',
+    'plugin_id',
+    'check_id',
+    'control_id'
+]
+
+failing_results = [ 'FAILED', 'ERROR' ]
+
+# values that are unique to each result are not worth interning
+unique_fields = [ 'actual_value', 'error' ]
+
+definition_fields = [ 'info', 'solution', 'see_also', 'reference', 'policy_value' ]
+
+summary_fields = [ 'control_id', 'check_name', 'hosts', 'PASSED', 'WARNING', 'FAILED', 'ERROR' ]
 
 result_value = {
     'ERROR': 4,
@@ -46,27 +124,114 @@ def field_order_key(item):
         return (999, item.lower())
 
 
+class ComplianceResult(collections.abc.MutableMapping):
+    # a fixed slot for each known field keeps results compact, with a dict
+    # only created for fields that are not known
+    __slots__ = tuple(compliance_fields + ['definition', 'extra'])
+
+    def __init__(self, *args, **kwargs):
+        self.extra = None
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        if key in result_slots:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in result_slots:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in result_slots:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self.extra is None:
+            raise KeyError(key)
+        else:
+            del self.extra[key]
+
+    def __iter__(self):
+        for key in result_slot_order:
+            if hasattr(self, key):
+                yield key
+        if self.extra is not None:
+            for key in self.extra:
+                yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+result_slot_order = compliance_fields + ['definition']
+result_slots = frozenset(result_slot_order)
+
+
+def project_result(item, fields=None, include_ids=True):
+    if fields:
+        return dict([(f, item[f]) for f in fields if f in item])
+    return dict([(k, item[k]) for k in item if include_ids or k[-3:] != '_id'])
+
+
 def parse_args(parameters):
-    global show_time, show_verbose, formats
+    global show_time, show_verbose, show_stderr, formats
+
+    if parameters[:1] == ['diff']:
+        return parse_diff_args(parameters[1:])
+    if parameters[:1] == ['index']:
+        return parse_index_args(parameters[1:])
 
     parser = argparse.ArgumentParser(description='Read .nessus and convert to different format')
 
+    parser.add_argument('-d', '--definitions', action='store_true',
+                        help='store check definitions once and reference them from results')
     parser.add_argument('-f', '--format', type=str, nargs=1, default=[ 'json' ],
                         help='format to output; {}'.format(', '.join(formats)))
+    parser.add_argument('--fields', type=str, default=None,
+                        help='comma separated list of fields to output')
+    parser.add_argument('--host', type=str, action='append', default=None,
+                        help='only convert hosts matching name or glob, or regex prefixed with re:')
+    parser.add_argument('--plugin-id', type=str, default=None,
+                        help='comma separated list of plugin ids to convert')
+    parser.add_argument('--result', type=str, default=None,
+                        help='comma separated list of results to convert; {}'.format(
+                            ', '.join(result_value.keys())))
 
     parser.add_argument('-i', '--include_ids', action='store_true',
                         help='include internal identifiers')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of files to convert in parallel')
     parser.add_argument('-o', '--overwrite', action='store_true',
                         help='overwrite output file if it exists')
+    parser.add_argument('--output', type=str, default=None,
+                        help='override filename of output file, - for stdout')
+    parser.add_argument('-z', '--compress', action='store_true',
+                        help='write gzip compressed output')
     parser.add_argument('-r', '--rollup', action='store_true',
                         help='rollup the results')
+    parser.add_argument('-s', '--summary', action='store_true',
+                        help='summarize results of each control across hosts')
     parser.add_argument('-t', '--timestamp', action='store_true',
                         help='show timestamp on output')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='show verbose output')
 
     parser.add_argument('files', type=str, nargs='+',
-                        help='nessus file to update')
+                        help='nessus file to update, - for stdin')
 
     args = parser.parse_args(parameters)
 
@@ -75,24 +240,157 @@ def parse_args(parameters):
     if args.verbose:
         show_verbose = True
 
+    if args.output is None and args.files == ['-']:
+        args.output = '-'
+
+    # keep stdout clean for the converted data
+    if args.output == '-':
+        show_stderr = True
+
     args.format = args.format[0]
 
+    if args.fields:
+        args.fields = [f.strip() for f in args.fields.split(',') if f.strip()]
+
     if args.format not in formats:
         display('ERROR: Unknown file format: {}'.format(args.format), exit_code=1)
 
+    # the identifiers are the indexed columns of the database
+    if args.format == 'sqlite':
+        args.include_ids = True
+
+    args.command = 'convert'
+
+    if args.jobs < 1:
+        display('ERROR: Invalid number of jobs: {}'.format(args.jobs), exit_code=1)
+
+    if args.output is not None and len(args.files) > 1:
+        display('ERROR: Output filename can only be used with a single file', exit_code=1)
+
+    if args.files.count('-') > 1:
+        display('ERROR: Standard input can only be read once', exit_code=1)
+
+    # an output name can not be made from stdin
+    if '-' in args.files and len(args.files) > 1:
+        display('ERROR: Standard input can not be converted with other files', exit_code=1)
+
+    if args.output == '-':
+        if args.format == 'sqlite':
+            display('ERROR: Unable to write sqlite to stdout', exit_code=1)
+        if args.summary or (args.definitions and args.format != 'json'):
+            display('ERROR: Additional output files can not be written with stdout', exit_code=1)
+
     return args
 
 
-def display(message, verbose=False, exit_code=0):
+def parse_diff_args(parameters):
+    global show_time, show_verbose, show_stderr, formats
+
+    parser = argparse.ArgumentParser(prog='nessus_convert.py diff',
+                                     description='Compare two .nessus files and output changed results')
+
+    parser.add_argument('-f', '--format', type=str, nargs=1, default=[ 'json' ],
+                        help='format to output; {}'.format(', '.join(formats)))
+    parser.add_argument('--host', type=str, action='append', default=None,
+                        help='only compare hosts matching name or glob, or regex prefixed with re:')
+    parser.add_argument('--plugin-id', type=str, default=None,
+                        help='comma separated list of plugin ids to compare')
+
+    parser.add_argument('-o', '--overwrite', action='store_true',
+                        help='overwrite output file if it exists')
+    parser.add_argument('--output', type=str, default=None,
+                        help='override filename of output file, - for stdout')
+    parser.add_argument('-z', '--compress', action='store_true',
+                        help='write gzip compressed output')
+    parser.add_argument('-t', '--timestamp', action='store_true',
+                        help='show timestamp on output')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show verbose output')
+
+    parser.add_argument('old', type=str,
+                        help='nessus file with the earlier results')
+    parser.add_argument('new', type=str,
+                        help='nessus file with the later results, - for stdin')
+
+    args = parser.parse_args(parameters)
+
+    if args.timestamp:
+        show_time = True
+    if args.verbose:
+        show_verbose = True
+
+    if args.output is None and args.new == '-':
+        args.output = '-'
+
+    # keep stdout clean for the compared data
+    if args.output == '-':
+        show_stderr = True
+
+    args.command = 'diff'
+    args.format = args.format[0]
+    args.result = None
+    args.fields = None
+    args.rollup = False
+
+    if args.format not in formats:
+        display('ERROR: Unknown file format: {}'.format(args.format), exit_code=1)
+
+    if args.output == '-' and args.format == 'sqlite':
+        display('ERROR: Unable to write sqlite to stdout', exit_code=1)
+
+    if args.old == '-':
+        display('ERROR: The old file is indexed first and can not be read from stdin', exit_code=1)
+
+    return args
+
+
+def parse_index_args(parameters):
     global show_time, show_verbose
 
+    parser = argparse.ArgumentParser(prog='nessus_convert.py index',
+                                     description='Build an index of the hosts in .nessus files')
+
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='rebuild the index even if it is up to date')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='list the hosts and result counts in the index')
+    parser.add_argument('-t', '--timestamp', action='store_true',
+                        help='show timestamp on output')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show verbose output')
+
+    parser.add_argument('files', type=str, nargs='+',
+                        help='nessus file to index')
+
+    args = parser.parse_args(parameters)
+
+    if args.timestamp:
+        show_time = True
+    if args.verbose:
+        show_verbose = True
+
+    args.command = 'index'
+
+    return args
+
+
+def set_display(timestamp, verbose, stderr=False):
+    global show_time, show_verbose, show_stderr
+    show_time = timestamp
+    show_verbose = verbose
+    show_stderr = stderr
+
+
+def display(message, verbose=False, exit_code=0):
+    global show_time, show_verbose, show_stderr, last_error
+
     if show_time:
         now = datetime.datetime.now()
         timestamp = datetime.datetime.strftime(now, '%Y/%m/%d %H:%M:%S')
         message = '{} {}'.format(timestamp, message)
 
     out = sys.stdout
-    if exit_code > 0:
+    if exit_code > 0 or show_stderr:
         out = sys.stderr
 
     if verbose and show_verbose:
@@ -103,49 +401,214 @@ def display(message, verbose=False, exit_code=0):
     out.flush()
 
     if exit_code > 0:
+        last_error = message.rstrip()
         sys.exit(exit_code)
 
 
-def get_compliance_data(filename):
-    data = []
-    if not os.path.isfile(filename):
-        display('File does not exist: {}'.format(filename), exitcode=2)
+def get_compression(fin):
+    magic = fin.peek(8)[:8]
+    for compression in compressions:
+        if magic.startswith(compressions[compression][0]):
+            return compression
+    return None
+
+
+def is_compressed(filename):
+    with open(filename, 'rb') as fin:
+        return get_compression(fin) is not None
+
+
+def open_input(filename):
+    if filename == '-':
+        fin = sys.stdin.buffer
+    else:
+        fin = open(filename, 'rb')
+    compression = get_compression(fin)
+
+    if compression is not None:
+        display('Reading {} compressed {}'.format(compression, filename), verbose=True)
+
+    if compression == 'gzip':
+        return gzip.open(fin)
+    elif compression == 'bz2':
+        return bz2.open(fin)
+    elif compression == 'xz':
+        return lzma.open(fin)
+    elif compression == 'zip':
+        if not fin.seekable():
+            raise Exception('Unable to read zip archive from a stream: {}'.format(filename))
+        archive = zipfile.ZipFile(fin)
+        names = [n for n in archive.namelist() if n.lower().endswith('.nessus')]
+        if not names:
+            names = [n for n in archive.namelist() if not n.endswith('/')]
+        if not names:
+            raise Exception('No files found in zip archive: {}'.format(filename))
+        return archive.open(names[0])
+
+    return fin
+
+
+def open_output(filename, compress=False):
+    if filename == '-':
+        sys.stdout.flush()
+        if compress:
+            stdout = os.fdopen(sys.stdout.fileno(), 'wb', closefd=False)
+            return io.TextIOWrapper(gzip.GzipFile(fileobj=stdout, mode='wb'))
+        return os.fdopen(sys.stdout.fileno(), 'w', closefd=False)
+    if compress or filename.endswith(compressions['gzip'][1]):
+        return gzip.open(filename, 'wt')
+    return open(filename, 'w')
+
+
+def get_basename(filename):
+    name = filename
+    for compression in compressions:
+        if name.lower().endswith(compressions[compression][1]):
+            name = name[:-len(compressions[compression][1])]
+            # an archive such as scan.zip has no inner extension to remove
+            if '.' not in os.path.basename(name):
+                return name
+            break
+    return '.'.join(name.split('.')[:-1])
+
+
+def get_compliance_data(filename, filters=None):
+    return list(iter_compliance_data(filename, filters))
+
+
+def make_filters(args):
+    filters = {
+        'results': None,
+        'hosts': None,
+        'plugin_ids': None,
+        'fields': None
+    }
+
+    if args.result:
+        filters['results'] = set([r.strip().upper() for r in args.result.split(',')])
+
+    if args.host:
+        filters['hosts'] = [make_host_pattern(h) for h in args.host]
+
+    if args.plugin_id:
+        filters['plugin_ids'] = set([p.strip() for p in args.plugin_id.split(',')])
+
+    if args.fields:
+        fields = set(args.fields)
+        # fields needed to filter, rollup and summarize are parsed, then projected out
+        if filters['results'] is not None:
+            fields.add('result')
+        if args.rollup:
+            fields.update(['control_id', 'check_name', 'result', 'reference', 'actual_value', 'error'])
+        if args.summary:
+            fields.update(['control_id', 'check_name', 'result'])
+        # a definition is only useful with some definition fields in it
+        if args.definitions and not fields.intersection(definition_fields):
+            fields.update(definition_fields)
+        filters['fields'] = fields
+
+    return filters
+
+
+def make_host_pattern(pattern):
+    if pattern.startswith('re:'):
+        return re.compile(pattern[3:])
+    return re.compile(fnmatch.translate(pattern))
+
+
+def match_host(name, patterns):
+    if patterns is None:
+        return True
+    if name is None:
+        return False
+    for pattern in patterns:
+        if pattern.match(name):
+            return True
+    return False
+
+
+def iter_compliance_data(filename, filters=None):
+    source = filename
+    if isinstance(filename, str):
+        if filename != '-' and not os.path.isfile(filename):
+            display('File does not exist: {}'.format(filename), exit_code=2)
+        display('Reading {}'.format(filename), verbose=True)
+        try:
+            source = open_input(filename)
+        except Exception as e:
+            display('ERROR: get_compliance_data(): {}'.format(e), exit_code=1)
+
+    if filters is None:
+        filters = {}
+    results = filters.get('results')
+    hosts = filters.get('hosts')
+    plugin_ids = filters.get('plugin_ids')
+    fields = filters.get('fields')
 
     try:
         report_name = 'None'
         is_compliance = False
+        report_elem = None
         host_value = None
         item_value = None
         record_host_properties = False
+        skip_host = False
+        skip_item = False
 
-        for event, elem in ET.iterparse(filename, events=('start', 'end')):
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
             if event == 'end' and elem.tag == 'policyName':
                 report_name = elem.text
 
             elif event == 'start':
-                if elem.tag == 'ReportHost':
-                    host_value = {
-                      'report': report_name,
-                      'target': elem.attrib.get('name', None)
-                    }
+                if elem.tag == 'Report':
+                    report_elem = elem
+
+                elif elem.tag == 'ReportHost':
+                    target = elem.attrib.get('name', None)
+                    skip_host = not match_host(target, hosts)
+                    if skip_host:
+                        display('Skipping host {}'.format(target), verbose=True)
+                    else:
+                        host_value = {
+                          'report': report_name,
+                          'target': target
+                        }
+
+                elif skip_host:
+                    continue
 
                 elif elem.tag == 'HostProperties':
                     record_host_properties = True
 
                 elif elem.tag == 'ReportItem':
-                    item_value = {
-                        'plugin_id': elem.attrib['pluginID'],
-                        'plugin_name': elem.attrib['pluginName']
-                    }
+                    skip_item = (plugin_ids is not None and
+                                 elem.attrib.get('pluginID') not in plugin_ids)
+                    if not skip_item:
+                        item_value = ComplianceResult()
+                        if fields is None or 'plugin_id' in fields:
+                            item_value['plugin_id'] = sys.intern(elem.attrib['pluginID'])
+                        if fields is None or 'plugin_name' in fields:
+                            item_value['plugin_name'] = sys.intern(elem.attrib['pluginName'])
 
             elif event == 'end':
                 if elem.tag == 'ReportHost':
-                    data.append(host_value)
+                    if not skip_host:
+                        yield host_value
                     host_value = None
+                    skip_host = False
+                    # release the finished host so memory stays flat
+                    elem.clear()
+                    if report_elem is not None:
+                        report_elem.remove(elem)
+
+                elif skip_host:
+                    if elem.tag == 'ReportItem':
+                        elem.clear()
 
                 elif elem.tag == 'HostProperties':
                     record_host_properties = False
                     host_value['results'] = []
+                    elem.clear()
 
                 elif record_host_properties:
                     tag_name = elem.attrib.get('name', None)
@@ -157,180 +620,936 @@ def get_compliance_data(filename):
                             host_value[tag_name] = elem.text
 
                 elif elem.tag == 'ReportItem':
-                    if is_compliance:
-                        host_value['results'].append(item_value)
+                    if is_compliance and not skip_item:
+                        if results is None or item_value.get('result') in results:
+                            host_value['results'].append(item_value)
                     item_value = None
                     is_compliance = False
+                    skip_item = False
+                    elem.clear()
+
+                elif skip_item:
+                    continue
 
                 elif '{http://www.nessus.org/cm}' in elem.tag:
                     is_compliance = True
                     field = elem.tag.replace('{http://www.nessus.org/cm}compliance-', '')
                     if field not in ('source', 'uname', 'dbtype'):
-                        item_value[field.replace('-', '_')] = elem.text
+                        field = field.replace('-', '_')
+                        if fields is None or field in fields:
+                            value = elem.text
+                            # repeated text across hosts shares one string
+                            if value is not None and field not in unique_fields:
+                                value = sys.intern(value)
+                            item_value[field] = value
+
+                elif elem.tag == 'Policy':
+                    elem.clear()
 
     except Exception as e:
         display('ERROR: get_compliance_data(): {}'.format(e), exit_code=1)
+    finally:
+        if source is not filename and source is not sys.stdin.buffer:
+            source.close()
+
 
-    return data
+def scan_compliance_fields(filename):
+    fields = set(['target', 'plugin_id', 'plugin_name'])
+    try:
+        display('Scanning fields in {}'.format(filename), verbose=True)
+        with open_input(filename) as fin:
+            tail = b''
+            while True:
+                chunk = fin.read(scan_size)
+                if not chunk:
+                    break
+                block = tail + chunk
+                for field in field_regex.findall(block):
+                    fields.add(field.decode('utf-8'))
+                # keep enough of the block to catch a tag split across reads
+                tail = block[-64:]
+    except Exception as e:
+        display('ERROR: scan_compliance_fields(): {}'.format(e), exit_code=1)
 
+    fields.difference_update(['source', 'uname', 'dbtype'])
 
-def collapse(data):
-    global result_value
+    return set([f.replace('-', '_') for f in fields])
+
+
+def get_output_fields(filename, include_ids=False, rolled_up=False, definitions=False, selected=None):
+    if selected:
+        # selected fields keep the order they were given in
+        fields = list(selected)
+        if definitions:
+            fields = [f for f in fields if f not in definition_fields] + ['definition']
+        return fields
+
+    if filename == '-':
+        # stdin can not be scanned ahead, so the known fields are used
+        fields = set(compliance_fields)
+    else:
+        fields = scan_compliance_fields(filename)
+
+    if rolled_up:
+        fields.update(['actual_value', 'error'])
+
+    if definitions:
+        fields.difference_update(definition_fields)
+        fields.add('definition')
+
+    if not include_ids:
+        fields = set([f for f in fields if f[-3:] != '_id'])
 
-    desc = ''
-    for i in range(min([len(data[0]['check_name']), len(data[1]['check_name'])])):
-        if data[0]['check_name'][i] != data[1]['check_name'][i]:
+    return sorted(fields, key=field_order_key)
+
+
+def find_report_hosts(filename):
+    offsets = []
+    report_end = None
+    try:
+        with open(filename, 'rb') as fin:
+            position = 0
+            tail = b''
+            while True:
+                chunk = fin.read(scan_size)
+                if not chunk:
+                    break
+                block = tail + chunk
+                base = position - len(tail)
+                start = 0
+                while True:
+                    found = block.find(b'<ReportHost', start)
+                    if found < 0 or found + 11 >= len(block):
+                        break
+                    if block[found + 11:found + 12] in (b' ', b'>', b'\t', b'\n', b'\r'):
+                        if not offsets or offsets[-1] < base + found:
+                            offsets.append(base + found)
+                    start = found + 11
+                found = block.rfind(b'</Report>')
+                if found >= 0:
+                    report_end = base + found
+                position += len(chunk)
+                tail = block[-16:]
+    except Exception as e:
+        display('ERROR: find_report_hosts(): {}'.format(e), exit_code=1)
+
+    return (offsets, report_end)
+
+
+def get_index_filename(filename):
+    return filename + index_suffix
+
+
+def build_host_index(filename):
+    (offsets, report_end) = find_report_hosts(filename)
+    if report_end is None:
+        raise Exception('No Report found in {}'.format(filename))
+
+    spans = []
+    bounds = offsets[1:] + [report_end]
+    with open(filename, 'rb') as fin:
+        for (start, end) in zip(offsets, bounds):
+            digest = hashlib.sha1()
+            fin.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = fin.read(min(scan_size, remaining))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                remaining -= len(chunk)
+            spans.append((start, end - start, digest.hexdigest()))
+
+    # only the result of each item is needed to count them
+    hosts = []
+    for host in iter_compliance_data(filename, {'fields': set(['result'])}):
+        if len(hosts) >= len(spans):
             break
-        desc += data[0]['check_name'][i]
+        (offset, length, digest) = spans[len(hosts)]
+        counts = collections.Counter([i['result'] for i in host['results'] if i.get('result')])
+        hosts.append({
+            'name': host['target'],
+            'host_ip': host.get('host_ip'),
+            'host_fqdn': host.get('host_fqdn'),
+            'offset': offset,
+            'length': length,
+            'total': len(host['results']),
+            'results': dict(counts),
+            'sha1': digest
+        })
+
+    if len(hosts) != len(spans):
+        raise Exception('Found {} hosts but {} ReportHost sections in {}'.format(
+            len(hosts), len(spans), filename))
+
+    return {
+        'version': index_version,
+        'header_end': offsets[0] if offsets else report_end,
+        'report_end': report_end,
+        'hosts': hosts
+    }
+
+
+def load_host_index(filename):
+    # offsets can only be used on an uncompressed file
+    if filename == '-' or is_compressed(filename):
+        return None
+
+    index_file = get_index_filename(filename)
+    if not os.path.isfile(index_file):
+        return None
+
+    stat = os.stat(filename)
+    try:
+        with open(index_file, 'r') as fin:
+            index = json.load(fin)
+    except Exception as e:
+        display('Unable to read host index {}: {}'.format(index_file, e), verbose=True)
+        return None
+
+    if (index.get('version') != index_version or index.get('size') != stat.st_size or
+            index.get('mtime') != stat.st_mtime):
+        display('Host index is out of date: {}'.format(index_file), verbose=True)
+        return None
+
+    display('Using host index {}'.format(index_file), verbose=True)
+    return index
+
+
+def write_host_index(filename):
+    index_file = get_index_filename(filename)
+    display('Indexing file: {}'.format(filename))
+
+    stat = os.stat(filename)
+    index = build_host_index(filename)
+    index['size'] = stat.st_size
+    index['mtime'] = stat.st_mtime
+
+    # replace the index in one step so readers never see a partial file
+    temp_file = '{}.{}'.format(index_file, os.getpid())
+    try:
+        with open(temp_file, 'w') as fout:
+            json.dump(index, fout)
+        os.replace(temp_file, index_file)
+    except Exception as e:
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
+        display('ERROR: write_host_index(): writing file: {}: {}'.format(index_file, e), exit_code=1)
+
+    display('Wrote {} hosts to {}'.format(len(index['hosts']), index_file), verbose=True)
+    return index
+
+
+def get_shards(filename, count, patterns=None):
+    # offsets can only be used on an uncompressed file
+    if filename == '-' or is_compressed(filename):
+        display('Unable to split compressed file: {}'.format(filename), verbose=True)
+        return None
+
+    index = load_host_index(filename)
+    if index is None:
+        # without an index there is nothing to gain from a single shard
+        if count < 2:
+            return None
+        (offsets, report_end) = find_report_hosts(filename)
+        if not offsets or report_end is None:
+            return None
+        bounds = offsets[1:] + [report_end]
+        index = {
+            'header_end': offsets[0],
+            'report_end': report_end,
+            'hosts': [{'offset': s, 'length': e - s} for (s, e) in zip(offsets, bounds)]
+        }
+        patterns = None
+
+    # hosts that do not match are never read from the file
+    hosts = [h for h in index['hosts'] if patterns is None or match_host(h.get('name'), patterns)]
+
+    size = max(1, min(shard_size, sum([h['length'] for h in hosts]) // count))
+    shards = []
+    start = None
+    end = None
+    for host in hosts:
+        if start is not None and (host['offset'] != end or end - start >= size):
+            shards.append((start, end))
+            start = None
+        if start is None:
+            start = host['offset']
+        end = host['offset'] + host['length']
+    if start is not None:
+        shards.append((start, end))
+
+    return (index['header_end'], index['report_end'], shards)
+
+
+def read_shard(filename, header_end, footer_start, start, end):
+    with open(filename, 'rb') as fin:
+        header = fin.read(header_end)
+        fin.seek(start)
+        hosts = fin.read(end - start)
+        fin.seek(footer_start)
+        footer = fin.read()
+
+    # the Policy and Report context wraps the hosts so they parse standalone
+    return io.BytesIO(header + hosts + footer)
+
+
+def parse_shard(filename, header_end, footer_start, start, end, args, filters):
+    shard = read_shard(filename, header_end, footer_start, start, end)
+    summary = {} if args.summary else None
+    return (list(read_hosts(shard, args, filters, summary)), summary)
+
+
+def iter_sharded_compliance_data(filename, args, filters, summary=None, jobs=1):
+    split = get_shards(filename, jobs, filters.get('hosts'))
+    if split is None:
+        for host in read_hosts(filename, args, filters, summary):
+            yield host
+        return
+
+    (header_end, footer_start, shards) = split
+
+    if jobs < 2 or len(shards) < 2:
+        for (start, end) in shards:
+            shard = read_shard(filename, header_end, footer_start, start, end)
+            for host in read_hosts(shard, args, filters, summary):
+                yield host
+        return
+
+    display('Splitting {} into {} shards'.format(filename, len(shards)), verbose=True)
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=set_display,
+            initargs=(show_time, show_verbose, show_stderr)) as executor:
+        pending = collections.deque()
+        for (start, end) in shards:
+            pending.append(executor.submit(parse_shard, filename, header_end, footer_start,
+                                           start, end, args, filters))
+            # bound the shards held in memory while keeping the workers busy
+            if len(pending) >= jobs * 2:
+                (hosts, partial) = pending.popleft().result()
+                if summary is not None:
+                    merge_summary(summary, partial)
+                for host in hosts:
+                    yield host
+
+        while pending:
+            (hosts, partial) = pending.popleft().result()
+            if summary is not None:
+                merge_summary(summary, partial)
+            for host in hosts:
+                yield host
+
+
+def get_common_name(first, second):
+    desc = os.path.commonprefix([first, second])
 
     if ' - ' in desc:
         desc = ' - '.join(desc.split(' - ')[:-1])
 
-    collapsed = {
-        'check_name': desc
+    return desc
+
+
+def format_actual(value):
+    if value is None:
+        return ''
+    return ''.join(['\n  {}'.format(line.replace('{}', '{{}}')) for line in value.split('\n')])
+
+
+def new_rollup():
+    return {
+        'count': 0,
+        'first': None,
+        'collapsed': None,
+        'refs': set(),
+        'actuals': []
     }
-    refs = set()
-    actuals = []
-    for item in data:
-        short_desc = ''
-        actual_desc = ''
-        actual_value = ''
-        for k in item:
-            if k == 'reference':
-                refs.update(item[k].split(','))
-            elif k == 'result':
-                actual_desc = item[k]
-                if k not in collapsed:
-                    collapsed[k] = item[k]
-                elif result_value[item[k]] > result_value[collapsed[k]]:
-                    collapsed[k] = item[k]
-            elif k == 'check_name':
-                short_desc = item[k].replace(desc, '')
-            elif k in ('actual_value', 'error'):
-                actual_value = ''
-                if item[k] is not None:
-                    for line in item[k].split('\n'):
-                        actual_value += '\n  {}'.format(line.replace('{}', '{{}}'))
-            elif k not in collapsed:
-                collapsed[k] = item[k]
-            elif item[k] != collapsed[k]:
-                collapsed[k] = 'multiple'
-            elif item[k] == collapsed[k]:
-                continue
-            else:
-                display('WARNING: Unknown result key: {}'.format(k))
-        actuals.append('{} {}:{}'.format(actual_desc, short_desc.strip(), actual_value))
 
 
-    collapsed['reference'] = ','.join(sorted(refs))
+def add_rollup(state, item):
+    global result_value
+
+    state['count'] += 1
+    if state['count'] == 1:
+        # a single result is kept as is, so only hold it until a second arrives
+        state['first'] = item
+        return
+
+    if state['count'] == 2:
+        first = state['first']
+        state['collapsed'] = ComplianceResult(
+            check_name=get_common_name(first['check_name'], item['check_name'])
+        )
+        state['first'] = None
+        add_rollup_item(state, first)
+
+    add_rollup_item(state, item)
+
+
+def add_rollup_item(state, item):
+    collapsed = state['collapsed']
+    desc = collapsed['check_name']
+
+    short_desc = ''
+    actual_desc = ''
+    actual_value = ''
+    for k in item:
+        if k == 'reference':
+            state['refs'].update(item[k].split(','))
+        elif k == 'result':
+            actual_desc = item[k]
+            if k not in collapsed:
+                collapsed[k] = item[k]
+            elif result_value[item[k]] > result_value[collapsed[k]]:
+                collapsed[k] = item[k]
+        elif k == 'check_name':
+            short_desc = item[k].replace(desc, '')
+        elif k in ('actual_value', 'error'):
+            actual_value = format_actual(item[k])
+        elif k not in collapsed:
+            collapsed[k] = item[k]
+        elif item[k] != collapsed[k]:
+            collapsed[k] = 'multiple'
+    state['actuals'].append('{} {}:{}'.format(actual_desc, short_desc.strip(), actual_value))
+
+
+def finish_rollup(state):
+    if state['count'] == 0:
+        display('ERROR: No data available for rollup.',  exit_code=1)
+
+    if state['count'] == 1:
+        return state['first']
+
+    collapsed = state['collapsed']
+    collapsed['reference'] = ','.join(sorted(state['refs']))
     if collapsed['result'] == 'ERROR':
-        collapsed['error'] = '\n'.join(actuals)
+        collapsed['error'] = '\n'.join(state['actuals'])
     else:
-        collapsed['actual_value'] = '\n'.join(actuals)
+        collapsed['actual_value'] = '\n'.join(state['actuals'])
 
     return collapsed
 
 
+def collapse(data):
+    state = new_rollup()
+    for item in data:
+        add_rollup(state, item)
+    return finish_rollup(state)
+
+
 def rollup(data):
-    rolledup_data = []
     controls = {}
     for value in data:
         control = value.get('control_id')
         if control is None:
             display('ERROR: No control found in result.',  exit_code=1)
         if control not in controls:
-           controls[control] = []
-        controls[control].append(value)
-
-    for control in controls:
-        if len(controls[control]) == 1:
-            rolledup_data.append(controls[control][0])
-        elif len(controls[control]) > 1:
-            rolledup_data.append(collapse(controls[control]))
-        else:
-            display('ERROR: No data available for rollup.',  exit_code=1)
+            controls[control] = new_rollup()
+        add_rollup(controls[control], value)
 
-    return rolledup_data
+    return [finish_rollup(controls[control]) for control in controls]
 
 
-def sanitize_ids(data):
-    new_data = []
+def count_controls(results, summary):
+    global result_value
 
-    for item in data:
-        new_item = {}
-        for k in item:
-            if k[-3:] != '_id':
-                new_item[k] = item[k]
-        new_data.append(new_item)
-        
-    return new_data
-
-
-def write_data(filename, file_format, data):
-    new_file = '.'.join(filename.split('.')[:-1]) + '.' + file_format
-    if os.path.isfile(new_file) and not args.overwrite:
+    # the worst result of each control on the host is counted once
+    host_controls = {}
+    for item in results:
+        control = item.get('control_id', item.get('check_name'))
+        result = item.get('result')
+        name = item.get('check_name', '')
+        if control not in host_controls:
+            host_controls[control] = [result, name]
+        else:
+            current = host_controls[control]
+            if result_value.get(result, 0) > result_value.get(current[0], 0):
+                current[0] = result
+            if name != current[1]:
+                current[1] = get_common_name(current[1], name)
+
+    for control in host_controls:
+        (result, name) = host_controls[control]
+        if control not in summary:
+            summary[control] = {
+                'control_id': control,
+                'check_name': name,
+                'hosts': 0
+            }
+            for key in result_value:
+                summary[control][key] = 0
+        entry = summary[control]
+        entry['hosts'] += 1
+        if result in result_value:
+            entry[result] += 1
+        if name != entry['check_name']:
+            entry['check_name'] = get_common_name(entry['check_name'], name)
+
+
+def merge_summary(summary, partial):
+    for control in partial:
+        if control not in summary:
+            summary[control] = partial[control]
+            continue
+        entry = summary[control]
+        for key in ['hosts'] + list(result_value.keys()):
+            entry[key] += partial[control][key]
+        if partial[control]['check_name'] != entry['check_name']:
+            entry['check_name'] = get_common_name(entry['check_name'], partial[control]['check_name'])
+
+
+def process_hosts(hosts, rolled_up=False, summary=None):
+    for host in hosts:
+        display('Found {} results for host {}.'.format(len(host['results']), host['target']), verbose=True)
+
+        if rolled_up:
+            host['results'] = rollup(host['results'])
+            display('Rolling up results to {}.'.format(len(host['results'])))
+
+        if summary is not None:
+            count_controls(host['results'], summary)
+
+        yield host
+
+
+def read_hosts(source, args, filters, summary=None):
+    hosts = iter_compliance_data(source, filters)
+    return process_hosts(hosts, args.rollup, summary)
+
+
+def get_projection(args):
+    # identifiers and unselected fields are dropped as each result is written
+    include_ids = args.include_ids or bool(args.fields)
+    if include_ids:
+        display('Retaining internal identifiers.', verbose=True)
+    fields = None
+    if args.fields:
+        # definition fields are replaced by the definition, as in get_output_fields
+        fields = get_output_fields(None, definitions=args.definitions, selected=args.fields)
+    return functools.partial(project_result, fields=fields, include_ids=include_ids)
+
+
+def get_definition_key(definition):
+    content = json.dumps(definition, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(content).hexdigest()[:16]
+
+
+def intern_definitions(hosts, definitions):
+    for host in hosts:
+        for item in host['results']:
+            definition = {}
+            for field in definition_fields:
+                if field in item:
+                    definition[field] = item.pop(field)
+            key = get_definition_key(definition)
+            if key not in definitions:
+                definitions[key] = definition
+            item['definition'] = key
+
+        yield host
+
+
+def write_data(filename, file_format, data, overwrite=False, fields=None, definitions=None,
+               summary=None, compress=False, output=None, project=dict):
+    basefile = get_basename(filename)
+    ext = '.' + file_format
+    if compress and file_format.lower() != 'sqlite':
+        ext += compressions['gzip'][1]
+    new_file = basefile + ext
+
+    if output == '-':
+        new_file = output
+    elif output:
+        new_file = output
+        basefile = get_basename(output)
+        ext = output[len(basefile):]
+
+    if new_file != '-' and os.path.isfile(new_file) and not overwrite:
         display('WARNING: File exists, not writing: {}'.format(new_file))
         return
 
-    if file_format.lower() == 'csv':
-        write_csv(new_file, data)
-    elif file_format.lower() == 'json':
-        write_json(new_file, data)
-
-
-def write_csv(filename, data):
+    try:
+        if file_format.lower() == 'csv':
+            write_csv(new_file, data, fields, compress)
+        elif file_format.lower() == 'json':
+            write_json(new_file, data, definitions, compress, project)
+        elif file_format.lower() == 'jsonl':
+            write_jsonl(new_file, data, compress, project)
+        elif file_format.lower() == 'sqlite':
+            write_sqlite(new_file, data, fields, definitions, summary)
+
+        if definitions is not None and file_format.lower() in ('csv', 'jsonl'):
+            write_definitions(basefile + '.definitions' + ext, file_format, definitions)
+        if summary is not None and file_format.lower() != 'sqlite':
+            write_summary(basefile + '.summary' + ext, file_format, summary)
+    except BaseException:
+        # do not leave a partially converted file behind
+        if new_file != '-' and os.path.isfile(new_file):
+            os.remove(new_file)
+        raise
+
+
+def write_csv(filename, data, fields, compress=False):
     display('Writing CSV file: {}'.format(filename))
 
-    fields = set(['target'])
-    values = []
-    for host in data:
-        target = host['target']
-        for item in host['results']:
-            fields.update(item.keys())
-            item['target'] = target
-            values.append(item)
-
-    ordered_fields = sorted(fields, key=field_order_key)
-
-
     try:
-        with open(filename, 'w') as cout:
+        with open_output(filename, compress) as cout:
             writer = csv.DictWriter(
                 cout,
-                fieldnames=ordered_fields,
+                fieldnames=fields,
                 dialect='excel',
-                quoting=csv.QUOTE_ALL
+                quoting=csv.QUOTE_ALL,
+                extrasaction='ignore'
             )
             writer.writeheader()
-            for value in values:
-                writer.writerow(value)
+            for host in data:
+                target = host['target']
+                for item in host['results']:
+                    item['target'] = target
+                    writer.writerow(item)
     except Exception as e:
         display('ERROR: write_csv_file(): writing file: {}: {}'.format(filename, e), exit_code=1)
 
 
-def write_json(filename, data):
+def write_json(filename, data, definitions=None, compress=False, project=dict):
     display('Writing JSON file: {}'.format(filename))
-    with open(filename, 'w') as jout:
-        json.dump(data, jout)
+    with open_output(filename, compress) as jout:
+        if definitions is not None:
+            jout.write('{"hosts": ')
+        jout.write('[')
+        for count, host in enumerate(data):
+            if count > 0:
+                jout.write(', ')
+            value = dict(host)
+            value['results'] = [project(item) for item in host['results']]
+            json.dump(value, jout)
+        jout.write(']')
+        if definitions is not None:
+            # definitions are complete once every host has been written
+            jout.write(', "definitions": ')
+            json.dump(definitions, jout)
+            jout.write('}')
+
+
+def write_jsonl(filename, data, compress=False, project=dict):
+    display('Writing JSON Lines file: {}'.format(filename))
+    with open_output(filename, compress) as jout:
+        for host in data:
+            for item in host['results']:
+                value = {'target': host['target']}
+                value.update(project(item))
+                jout.write(json.dumps(value) + '\n')
 
 
-if __name__ == '__main__':
-    args = parse_args(sys.argv[1:])
+def write_table(filename, file_format, fields, rows):
+    try:
+        with open_output(filename) as tout:
+            if file_format.lower() == 'csv':
+                writer = csv.DictWriter(
+                    tout,
+                    fieldnames=fields,
+                    dialect='excel',
+                    quoting=csv.QUOTE_ALL
+                )
+                writer.writeheader()
+                for row in rows:
+                    writer.writerow(row)
+            elif file_format.lower() == 'json':
+                json.dump(list(rows), tout)
+            else:
+                for row in rows:
+                    tout.write(json.dumps(row) + '\n')
+    except Exception as e:
+        display('ERROR: write_table(): writing file: {}: {}'.format(filename, e), exit_code=1)
 
-    for filename in args.files:
+
+def write_definitions(filename, file_format, definitions):
+    display('Writing definitions file: {}'.format(filename))
+    fields = ['definition'] + definition_fields
+    rows = (dict([('definition', key)] + list(definitions[key].items())) for key in definitions)
+    write_table(filename, file_format, fields, rows)
+
+
+def write_summary(filename, file_format, summary):
+    display('Writing summary file: {}'.format(filename))
+    write_table(filename, file_format, summary_fields, summary.values())
+
+
+def write_sqlite(filename, data, fields, definitions=None, summary=None):
+    display('Writing SQLite file: {}'.format(filename))
+
+    if os.path.isfile(filename):
+        os.remove(filename)
+
+    columns = [f for f in fields if f != 'target']
+    quoted = ', '.join(['"{}"'.format(c) for c in columns])
+
+    try:
+        conn = sqlite3.connect(filename)
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('CREATE TABLE hosts (host_id INTEGER PRIMARY KEY, {})'.format(
+            ', '.join(['"{}"'.format(c) for c in host_columns])))
+        conn.execute(('CREATE TABLE results (result_id INTEGER PRIMARY KEY, '
+                      'host_id INTEGER REFERENCES hosts(host_id), {})').format(quoted))
+
+        host_sql = 'INSERT INTO hosts VALUES (?, {})'.format(', '.join(['?'] * len(host_columns)))
+        result_sql = 'INSERT INTO results (host_id, {}) VALUES (?, {})'.format(
+            quoted, ', '.join(['?'] * len(columns)))
+
+        batch = []
+        for host_id, host in enumerate(data, 1):
+            conn.execute(host_sql, [host_id] + [host.get(c) for c in host_columns])
+            for item in host['results']:
+                batch.append([host_id] + [item.get(c) for c in columns])
+            if len(batch) >= batch_size:
+                conn.executemany(result_sql, batch)
+                conn.commit()
+                batch = []
+
+        conn.executemany(result_sql, batch)
+        conn.commit()
+
+        view_sql = ('CREATE VIEW compliance AS SELECT hosts.target, results.* '
+                    'FROM results JOIN hosts USING (host_id)')
+        if definitions is not None:
+            conn.execute('CREATE TABLE definitions (definition TEXT PRIMARY KEY, {})'.format(
+                ', '.join(['"{}"'.format(c) for c in definition_fields])))
+            conn.executemany(
+                'INSERT INTO definitions VALUES (?, {})'.format(', '.join(['?'] * len(definition_fields))),
+                [[key] + [definitions[key].get(c) for c in definition_fields] for key in definitions])
+            conn.commit()
+            view_sql = ('CREATE VIEW compliance AS SELECT hosts.target, results.*, {} '
+                        'FROM results JOIN hosts USING (host_id) '
+                        'LEFT JOIN definitions USING (definition)').format(
+                ', '.join(['definitions."{}"'.format(c) for c in definition_fields]))
+
+        if summary is not None:
+            conn.execute('CREATE TABLE summary ({})'.format(
+                ', '.join(['"{}"'.format(c) for c in summary_fields])))
+            conn.executemany(
+                'INSERT INTO summary VALUES ({})'.format(', '.join(['?'] * len(summary_fields))),
+                [[entry[c] for c in summary_fields] for entry in summary.values()])
+            conn.commit()
+
+        # indexes are built after loading so the inserts stay fast
+        display('Indexing SQLite file: {}'.format(filename), verbose=True)
+        conn.execute('CREATE INDEX hosts_target ON hosts (target)')
+        conn.execute('CREATE INDEX results_host_id ON results (host_id)')
+        for column in ('result', 'plugin_id', 'control_id'):
+            if column in columns:
+                conn.execute('CREATE INDEX results_{0} ON results ("{0}")'.format(column))
+        conn.execute(view_sql)
+        conn.commit()
+        conn.close()
+    except sqlite3.Error as e:
+        display('ERROR: write_sqlite(): writing file: {}: {}'.format(filename, e), exit_code=1)
+
+
+def get_result_key(target, item):
+    return (target, item.get('check_id') or item.get('check_name'))
+
+
+def index_results(filename, filters=None):
+    index = {}
+    for host in iter_compliance_data(filename, filters):
+        for item in host['results']:
+            index[get_result_key(host['target'], item)] = item
+        display('Indexed {} results for host {}.'.format(len(host['results']), host['target']), verbose=True)
+
+    return index
+
+
+def get_change(old, new):
+    old_result = old.get('result') if old is not None else None
+    result = new.get('result')
+
+    if result in failing_results and old_result not in failing_results:
+        return 'failed'
+    elif old_result in failing_results and result not in failing_results:
+        return 'fixed'
+    elif old is None:
+        return None
+    elif result != old_result:
+        return 'changed'
+    elif new.get('actual_value') != old.get('actual_value'):
+        return 'value'
+
+    return None
+
+
+def diff_results(index, hosts):
+    for host in hosts:
+        changes = []
+        for item in host['results']:
+            old = index.pop(get_result_key(host['target'], item), None)
+            change = get_change(old, item)
+            if change is None:
+                continue
+            value = {
+                'change': change,
+                'check_name': item.get('check_name'),
+                'old_result': old.get('result') if old is not None else None,
+                'result': item.get('result'),
+                'old_actual_value': old.get('actual_value') if old is not None else None,
+                'actual_value': item.get('actual_value'),
+                'plugin_id': item.get('plugin_id'),
+                'check_id': item.get('check_id'),
+                'control_id': item.get('control_id')
+            }
+            changes.append(value)
+
+        display('Found {} changed results for host {}.'.format(len(changes), host['target']), verbose=True)
+        host['results'] = changes
+        yield host
+
+    # old results left in the index are missing from the later scan
+    removed = {}
+    for (key, old) in index.items():
+        removed.setdefault(key[0], []).append({
+            'change': 'removed',
+            'check_name': old.get('check_name'),
+            'old_result': old.get('result'),
+            'result': None,
+            'old_actual_value': old.get('actual_value'),
+            'actual_value': None,
+            'plugin_id': old.get('plugin_id'),
+            'check_id': old.get('check_id'),
+            'control_id': old.get('control_id')
+        })
+    index.clear()
+
+    for target in removed:
+        display('Found {} removed results for host {}.'.format(len(removed[target]), target), verbose=True)
+        yield {'target': target, 'results': removed[target]}
+
+
+def diff_files(args):
+    start = time.time()
+
+    for filename in (args.old, args.new):
+        if filename != '-' and not os.path.isfile(filename):
+            display('ERROR: File does not exist: {}'.format(filename), exit_code=2)
+
+    filters = make_filters(args)
+    # only the fields needed to compare and report are parsed
+    filters['fields'] = set(diff_fields)
+
+    display('Indexing file: {}'.format(args.old))
+    index = index_results(args.old, filters)
+
+    display('Comparing file: {}'.format(args.new))
+    hosts = iter_compliance_data(args.new, filters)
+    data = diff_results(index, hosts)
+
+    output = args.output
+    if output is None:
+        output = get_basename(args.new) + '.diff.' + args.format
+        if args.compress and args.format != 'sqlite':
+            output += compressions['gzip'][1]
+
+    write_data(args.new, args.format, data, args.overwrite, diff_fields,
+               compress=args.compress, output=output)
+
+    display('Compared files in {:.2f}s'.format(time.time() - start), verbose=True)
+
+
+def convert_file(filename, args, split_hosts=False):
+    start = time.time()
+    error = None
+
+    try:
         display('Processing file: {}'.format(filename))
-        data = get_compliance_data(filename)
-        for host in data:
-            display('Found {} results for host {}.'.format(len(host['results']), host['target']), verbose=True)
+        if filename != '-' and not os.path.isfile(filename):
+            display('ERROR: File does not exist: {}'.format(filename), exit_code=2)
+        filters = make_filters(args)
+        summary = {} if args.summary else None
+        if split_hosts or filters['hosts'] is not None:
+            jobs = args.jobs if split_hosts else 1
+            data = iter_sharded_compliance_data(filename, args, filters, summary, jobs)
+        else:
+            data = read_hosts(filename, args, filters, summary)
+        definitions = None
+        if args.definitions:
+            definitions = {}
+            data = intern_definitions(data, definitions)
+        fields = None
+        if args.format in ('csv', 'sqlite'):
+            fields = get_output_fields(filename, args.include_ids, args.rollup,
+                                       args.definitions, args.fields)
+        write_data(filename, args.format, data, args.overwrite, fields, definitions,
+                   summary, args.compress, args.output, get_projection(args))
+    except SystemExit:
+        error = last_error
+    except Exception as e:
+        error = 'ERROR: convert_file(): {}: {}'.format(filename, e)
 
-            if args.rollup:
-                host['results'] = rollup(host['results'])
-                display('Rolling up results to {}.'.format(len(host['results'])))
+    return (filename, time.time() - start, error)
 
-            if not args.include_ids:
-                host['results'] = sanitize_ids(host['results'])
-            else:
-                display('Retaining internal identifiers.')
 
-        write_data(filename, args.format, data)
+def convert_files(files, args):
+    if args.jobs == 1:
+        return [convert_file(filename, args) for filename in files]
+
+    if len(files) == 1:
+        return [convert_file(files[0], args, split_hosts=True)]
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.jobs,
+            initializer=set_display,
+            initargs=(show_time, show_verbose, show_stderr)) as executor:
+        futures = [executor.submit(convert_file, filename, args) for filename in files]
+        return [future.result() for future in futures]
 
+
+def index_files(args):
+    for filename in args.files:
+        if not os.path.isfile(filename):
+            display('ERROR: File does not exist: {}'.format(filename), exit_code=2)
+        if is_compressed(filename):
+            display('ERROR: Unable to index compressed file: {}'.format(filename), exit_code=1)
+
+        index = None
+        if not args.force:
+            index = load_host_index(filename)
+        if index is None:
+            try:
+                index = write_host_index(filename)
+            except Exception as e:
+                display('ERROR: index_files(): {}: {}'.format(filename, e), exit_code=1)
+        else:
+            display('Host index is up to date: {}'.format(get_index_filename(filename)))
+
+        if args.list:
+            for host in index['hosts']:
+                counts = ', '.join(['{}={}'.format(k, host['results'][k])
+                                    for k in result_value if k in host['results']])
+                display('{:<40} {:<16} {:>6} {}'.format(host['name'], host['host_ip'] or '',
+                                                         host['total'], counts))
+
+
+def report_results(results):
+    failures = [r for r in results if r[2] is not None]
+
+    if len(results) > 1:
+        for (filename, seconds, error) in results:
+            status = 'OK' if error is None else 'FAILED'
+            display('{:>9.2f}s {:<6} {}'.format(seconds, status, filename))
+
+    for (filename, seconds, error) in failures:
+        display('FAILED: {}: {}'.format(filename, error))
+
+    if failures:
+        display('ERROR: {} of {} files failed to convert'.format(len(failures), len(results)), exit_code=1)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    if args.command == 'diff':
+        diff_files(args)
+    elif args.command == 'index':
+        index_files(args)
+    else:
+        results = convert_files(args.files, args)
+        report_results(results)
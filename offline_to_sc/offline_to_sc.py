@@ -6,15 +6,50 @@
 
 
 import argparse
+import bz2
+import concurrent.futures
 import datetime
+import gzip
+import html
+import io
+import json
+import lzma
 import os
 import re
 import sys
+import zipfile
 
 import xml.etree.ElementTree as ET
 
+compressions = {
+    'gzip': b'\x1f\x8b',
+    'bz2': b'BZh',
+    'xz': b'\xfd7zXZ\x00',
+    'zip': b'PK\x03\x04'
+}
+
+regexes = {
+    'target': re.compile(b'(<preference>\\s*<name>TARGET</name>\\s*<value>)([^<]*)(</value>)'),
+    'name': re.compile(b'(\\sname\\s*=\\s*")([^"]*)(")')
+}
+
+scan_size = 1024 * 1024
+props_size = 64 * 1024
+
+index_suffix = '.idx.json'
+index_version = 1
+
+namespaces = {
+    'http://www.nessus.org/cm': 'cm'
+}
+
+nessus_extensions = ('.nessus', '.nessus.gz', '.nessus.bz2', '.nessus.xz', '.nessus.zip')
+
 show_verbose = False
 show_time = False
+last_error = None
+worker_values = None
+worker_mapping = None
 
 
 def parse_args(parameters):
@@ -34,11 +69,17 @@ def parse_args(parameters):
                         help='overwrite output file if it exists')
     parser.add_argument('-f', '--filename', nargs=1, default='',
                         help='override filename of output file')
+    parser.add_argument('-s', '--splice', action='store_true',
+                        help='copy the offline file through, only replacing the target and host properties')
+    parser.add_argument('-m', '--map', type=str, default=None,
+                        help='file of offline config name and template host pairs, one per line')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of offline files to process in parallel')
 
     parser.add_argument('template', type=str, nargs=1,
                         help='nessus file to use as template')
-    parser.add_argument('nessus', type=str, nargs=1,
-                        help='nessus file to use as results')
+    parser.add_argument('nessus', type=str, nargs='+',
+                        help='nessus files or directories of them to use as results')
 
     args = parser.parse_args(parameters)
 
@@ -49,11 +90,33 @@ def parse_args(parameters):
 
     args.filename = make_list(args.filename)[0]
     args.template = make_list(args.template)[0]
-    args.nessus = make_list(args.nessus)[0]
+    args.nessus = get_nessus_files(args.nessus)
+
+    if not args.nessus:
+        display('ERROR: No nessus files found to use as results', exit=1)
+
+    if args.filename and len(args.nessus) > 1:
+        display('ERROR: Output filename can only be used with a single file', exit=1)
+
+    if args.jobs < 1:
+        display('ERROR: Invalid number of jobs: {}'.format(args.jobs), exit=1)
 
     return args
 
 
+def get_nessus_files(targets):
+    files = []
+    for target in targets:
+        if os.path.isdir(target):
+            # earlier output in the directory is not used as results again
+            for name in sorted(os.listdir(target)):
+                if name.lower().endswith(nessus_extensions) and '.offline_import.' not in name:
+                    files.append(os.path.join(target, name))
+        else:
+            files.append(target)
+    return files
+
+
 def make_list(target=None):
     if target is None:
         return []
@@ -64,7 +127,7 @@ def make_list(target=None):
 
 
 def display(message, verbose=False, exit=0):
-    global show_time, show_verbose
+    global show_time, show_verbose, last_error
 
     if show_time:
         now = datetime.datetime.now()
@@ -81,14 +144,45 @@ def display(message, verbose=False, exit=0):
         out.write(message.rstrip() + '\n')
 
     if exit > 0:
+        last_error = message.rstrip()
         sys.exit(exit)
 
 
+def get_compression(fin):
+    magic = fin.peek(8)[:8]
+    for compression in compressions:
+        if magic.startswith(compressions[compression]):
+            return compression
+    return None
+
+
+def open_input(filename):
+    fin = open(filename, 'rb')
+    compression = get_compression(fin)
+
+    if compression == 'gzip':
+        return gzip.open(fin)
+    elif compression == 'bz2':
+        return bz2.open(fin)
+    elif compression == 'xz':
+        return lzma.open(fin)
+    elif compression == 'zip':
+        archive = zipfile.ZipFile(fin)
+        names = [n for n in archive.namelist() if n.lower().endswith('.nessus')]
+        if not names:
+            names = [n for n in archive.namelist() if not n.endswith('/')]
+        if not names:
+            raise Exception('No files found in zip archive: {}'.format(filename))
+        return archive.open(names[0])
+
+    return fin
+
+
 def read_file(filename):
     contents = ''
     try:
         display('Reading {}'.format(filename), verbose=True)
-        with open(filename, 'r') as file_in:
+        with io.TextIOWrapper(open_input(filename)) as file_in:
             contents = file_in.read()
     except Exception as e:
         display('ERROR: read_file(): reading file: {}: {}'.format(filename, e), exit=1)
@@ -108,28 +202,173 @@ def write_file(filename, content, overwrite=False):
         display('ERROR: write_file(): writing file: {}: {}'.format(filename, e), exit=1)
 
 
-def get_host_properties_from_nessus(contents):
-    values = {}
+def get_host_properties_from_nessus(source, index=None):
+    hosts = {}
 
     try:
-        tree = ET.fromstring(contents)
-        host = tree.find('Report/ReportHost')
-        name = host.attrib.get('name', None)
-        props = host.find('HostProperties')
-        values[name] = props
+        if index is not None:
+            report_hosts = iter_indexed_report_hosts(source, index)
+        else:
+            report_hosts = iter_report_hosts(source)
+        for elem in report_hosts:
+            name = elem.attrib.get('name', None)
+            props = elem.find('HostProperties')
+            if props is None:
+                props = ET.Element('HostProperties')
+            hosts[name] = props
+            display('Host Name: {}'.format(name), verbose=True)
     except Exception as e:
         display('ERROR: get_host_properties_from_nessus(): {}'.format(e), exit=1)
-        sys.exit(1)
 
-    display('Host Name: {}'.format(name), verbose=True)
+    if not hosts:
+        display('ERROR: get_host_properties_from_nessus(): no hosts found', exit=1)
+
+    display('Found {} hosts in template'.format(len(hosts)), verbose=True)
+
+    return {'hosts': hosts, 'index': index_template_hosts(hosts)}
+
+
+def iter_report_hosts(source):
+    # only the HostProperties are kept, the results are cleared as read
+    for (event, elem) in ET.iterparse(source):
+        if elem.tag == 'ReportItem':
+            elem.clear()
+        elif elem.tag == 'ReportHost':
+            yield elem
+            elem.clear()
+
+
+def iter_indexed_report_hosts(source, index):
+    marker = b'</HostProperties>'
+
+    # only the start of each host is read, up to the end of its HostProperties
+    for host in index['hosts']:
+        source.seek(host['offset'])
+        buf = bytearray()
+        remaining = host['length']
+        found = -1
+        while found < 0 and remaining > 0:
+            chunk = source.read(min(props_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            buf.extend(chunk)
+            found = buf.find(marker, max(0, len(buf) - len(chunk) - len(marker)))
+        if not buf.startswith(b'<ReportHost') or found < 0:
+            raise Exception('Unable to find HostProperties for {} in the host index'.format(host['name']))
+        yield ET.fromstring(bytes(buf[:found + len(marker)]) + b'</ReportHost>')
+
+
+def load_host_index(filename):
+    # the index written by nessus_convert.py index, while it matches the file
+    index_file = filename + index_suffix
+    if not os.path.isfile(index_file):
+        return None
+
+    try:
+        with open(filename, 'rb') as file_in:
+            if get_compression(file_in) is not None:
+                return None
+        stat = os.stat(filename)
+        with open(index_file, 'r') as file_in:
+            index = json.load(file_in)
+    except Exception as e:
+        display('Unable to read host index {}: {}'.format(index_file, e), verbose=True)
+        return None
+
+    if (index.get('version') != index_version or index.get('size') != stat.st_size or
+            index.get('mtime') != stat.st_mtime):
+        display('Host index is out of date: {}'.format(index_file), verbose=True)
+        return None
+
+    display('Using host index {}'.format(index_file), verbose=True)
+    return index
+
+
+def index_template_hosts(hosts):
+    index = {}
+
+    # a host name is never hidden by the address of another host
+    for name in hosts:
+        index[name.lower()] = name
+    for name in hosts:
+        for tag in hosts[name].findall('tag'):
+            if tag.attrib.get('name') in ('host-ip', 'host-fqdn') and tag.text:
+                index.setdefault(tag.text.strip().lower(), name)
+
+    return index
+
+
+def read_template(filename):
+    index = load_host_index(filename)
+
+    try:
+        display('Reading {}'.format(filename), verbose=True)
+        source = open_input(filename)
+    except Exception as e:
+        display('ERROR: read_template(): reading file: {}: {}'.format(filename, e), exit=1)
+
+    with source:
+        display('Retrieving properties')
+        return get_host_properties_from_nessus(source, index)
+
+
+def read_mapping(filename):
+    mapping = {}
+
+    for line in read_file(filename).split('\n'):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if ',' not in line:
+            display('ERROR: read_mapping(): expected name,host: {}'.format(line), exit=1)
+        (name, host) = [part.strip() for part in line.split(',', 1)]
+        mapping[name.lower()] = host
+
+    display('Read {} mappings from {}'.format(len(mapping), filename), verbose=True)
 
-    return values
+    return mapping
+
+
+def find_template_host(name, values, mapping=None):
+    key = name.lower()
+    if mapping is not None and key in mapping:
+        host = values['index'].get(mapping[key].lower())
+        if host is None:
+            raise Exception('Template host {} for {} was not found.'.format(mapping[key], name))
+        return host
+
+    return values['index'].get(key)
+
+
+def get_template_host(name, values, mapping=None):
+    host = find_template_host(name, values, mapping)
+    if host is not None:
+        return host
+
+    if len(values['hosts']) == 1:
+        return list(values['hosts'].keys())[0]
+
+    raise Exception('No template host found for {}.'.format(name))
+
+
+def get_report_host(report_name, name, host, values, mapping=None):
+    # the host named by the config name is already known, any others are
+    # looked up in the template index
+    if report_name.lower() == name.lower():
+        return host
+    return find_template_host(report_name, values, mapping)
 
 
 def create_filename(source, override):
     filename = override
 
     if not filename:
+        # the output is not compressed, so drop any compression extension
+        for ext in ('.gz', '.bz2', '.xz', '.zip'):
+            if source.lower().endswith(ext) and '.' in source[:-len(ext)]:
+                source = source[:-len(ext)]
+                break
         basefile = '.'.join(source.split('.')[:-1])
         ext = source.split('.')[-1]
         filename = '{}.{}.{}'.format(basefile, 'offline_import', ext)
@@ -144,106 +383,333 @@ def unixtime(date):
     return (date - epoch).total_seconds()
 
 
-def apply_values_to_nessus(contents, values):
+def get_offline_name(policy):
+    name = None
+    prefs = policy.findall('Preferences/PluginsPreferences/item')
+    for pref in prefs:
+        pref_name = pref.find('preferenceName').text
+        pref_selected = pref.find('selectedValue').text
+        if 'Offline config file' in pref_name and pref_selected:
+            name = pref_selected
+
+    if not name:
+        raise Exception('Unable to find the config name.')
+
+    return name
+
+
+def get_host_tags(props, start, end):
+    tags = props.findall('tag')
+    for tag in tags:
+        if tag.attrib['name'] == 'HOST_START_TIMESTAMP':
+            tag.text = str(unixtime(start))
+        elif tag.attrib['name'] == 'HOST_END_TIMESTAMP':
+            tag.text = str(unixtime(end))
+        elif tag.attrib['name'] == 'HOST_START':
+            tag.text = start.strftime('%c')
+        elif tag.attrib['name'] == 'HOST_END':
+            tag.text = end.strftime('%c')
+
+    return tags
+
+
+def apply_values_to_nessus(contents, values, mapping=None):
     start = datetime.datetime.now()
     end = datetime.datetime.now() + datetime.timedelta(0,1)
 
     try:
         tree = ET.fromstring(contents)
 
-        name = None
-        prefs = tree.findall('Policy/Preferences/PluginsPreferences/item')
-        for pref in prefs:
-            pref_name = pref.find('preferenceName').text
-            pref_selected = pref.find('selectedValue').text
-            if 'Offline config file' in pref_name and pref_selected:
-                name = pref_selected
-
-        if not name:
-            raise Exception('Unable to find the config name.')
-
-        for host in values:
-            display('Apply values: {}'.format(host), verbose=True)
-
-            # update TARGET preference
-            preferences = tree.find('Policy/Preferences/ServerPreferences')
-            for preference in preferences.findall('preference'):
-                if preference.find('name').text == 'TARGET':
-                    old = preference.find('value').text
-                    preference.find('value').text = host
-                    break
-
-            report_hosts = tree.findall('Report/ReportHost')
-            for report_host in report_hosts:
-                report_name = report_host.attrib['name']
-                display('Analyzing report: {}'.format(report_name), verbose=True)
-                if report_name.lower() == name.lower():
-                    display('Found report name: {}'.format(name), verbose=True)
-                    report_host.attrib['name'] = host
-
-                    old_props = report_host.find('HostProperties')
-                    for tag in old_props.findall('tag'):
-                        old_props.remove(tag)
-
-                    new_props = values[host]
-                    for tag in new_props.findall('tag'):
-                        if tag.attrib['name'] == 'HOST_START_TIMESTAMP':
-                            tag.text = str(unixtime(start))
-                        elif tag.attrib['name'] == 'HOST_END_TIMESTAMP':
-                            tag.text = str(unixtime(end))
-                        elif tag.attrib['name'] == 'HOST_START':
-                            tag.text = start.strftime('%c')
-                        elif tag.attrib['name'] == 'HOST_END':
-                            tag.text = end.strftime('%c')
-
-                        old_props.append(tag)
+        name = get_offline_name(tree.find('Policy'))
+        host = get_template_host(name, values, mapping)
+
+        display('Apply values: {}'.format(host), verbose=True)
+
+        # update TARGET preference
+        preferences = tree.find('Policy/Preferences/ServerPreferences')
+        for preference in preferences.findall('preference'):
+            if preference.find('name').text == 'TARGET':
+                old = preference.find('value').text
+                preference.find('value').text = host
+                break
+
+        report_hosts = tree.findall('Report/ReportHost')
+        for report_host in report_hosts:
+            report_name = report_host.attrib['name']
+            display('Analyzing report: {}'.format(report_name), verbose=True)
+            report_host_name = get_report_host(report_name, name, host, values, mapping)
+            if report_host_name is not None:
+                display('Found report name: {}'.format(report_name), verbose=True)
+                report_host.attrib['name'] = report_host_name
+
+                old_props = report_host.find('HostProperties')
+                for tag in old_props.findall('tag'):
+                    old_props.remove(tag)
+
+                for tag in get_host_tags(values['hosts'][report_host_name], start, end):
+                    old_props.append(tag)
 
     except Exception as e:
         display('ERROR: apply_values_to_nessus(): {}'.format(e), exit=1)
         sys.exit(1)
 
-    new_content = ET.tostring(tree, encoding='ascii', method='xml', short_empty_elements=False)
+    return serialize_nessus(tree)
+
+
+def read_until(source, buf, marker, position=0):
+    while True:
+        found = buf.find(marker, position)
+        if found >= 0:
+            return found
+        position = max(position, len(buf) - len(marker) + 1)
+        chunk = source.read(scan_size)
+        if not chunk:
+            return -1
+        buf.extend(chunk)
+
+
+def copy_until(source, buf, out, marker):
+    # bytes before the marker are written out as soon as they are read
+    while True:
+        found = buf.find(marker)
+        if found >= 0:
+            out.write(buf[:found])
+            del buf[:found]
+            return True
+        keep = len(buf) - len(marker) + 1
+        if keep > 0:
+            out.write(buf[:keep])
+            del buf[:keep]
+        chunk = source.read(scan_size)
+        if not chunk:
+            out.write(buf)
+            del buf[:]
+            return False
+        buf.extend(chunk)
+
+
+def copy_until_tag(source, buf, out, tag):
+    while copy_until(source, buf, out, tag):
+        # the tag name must end here, not continue as a longer name
+        if len(buf) <= len(tag):
+            buf.extend(source.read(scan_size))
+        if buf[len(tag):len(tag) + 1] in (b' ', b'>', b'/', b'\t', b'\n', b'\r'):
+            return True
+        out.write(buf[:len(tag)])
+        del buf[:len(tag)]
+    return False
+
+
+def splice_values_to_nessus(source, out, values, mapping=None):
+    start = datetime.datetime.now()
+    end = datetime.datetime.now() + datetime.timedelta(0,1)
+
+    try:
+        buf = bytearray()
+
+        # the Policy is small, and is read whole to find the config name
+        found = read_until(source, buf, b'</Policy>')
+        if found < 0:
+            raise Exception('Unable to find the Policy.')
+        policy_end = found + len(b'</Policy>')
+        policy = bytes(buf[buf.find(b'<Policy'):policy_end])
+        name = get_offline_name(ET.fromstring(policy))
+        host = get_template_host(name, values, mapping)
+        display('Apply values: {}'.format(host), verbose=True)
+
+        # update TARGET preference
+        value = escape_nessus_text(host).encode('ascii', 'xmlcharrefreplace')
+        out.write(regexes['target'].sub(lambda m: m.group(1) + value + m.group(3),
+                                        bytes(buf[:policy_end]), count=1))
+        del buf[:policy_end]
+
+        while copy_until_tag(source, buf, out, b'<ReportHost'):
+            tag_end = read_until(source, buf, b'>')
+            if tag_end < 0:
+                raise Exception('Unable to find the end of ReportHost.')
+            start_tag = bytes(buf[:tag_end + 1])
+            del buf[:tag_end + 1]
+
+            match = regexes['name'].search(start_tag)
+            report_name = ''
+            if match:
+                report_name = html.unescape(match.group(2).decode('utf-8'))
+            display('Analyzing report: {}'.format(report_name), verbose=True)
+            report_host_name = None
+            if match:
+                report_host_name = get_report_host(report_name, name, host, values, mapping)
+            if report_host_name is None:
+                out.write(start_tag)
+                continue
+
+            display('Found report name: {}'.format(report_name), verbose=True)
+            value = escape_nessus_attrib(report_host_name).encode('ascii', 'xmlcharrefreplace')
+            out.write(start_tag[:match.start(2)] + value + start_tag[match.end(2):])
+
+            # only the HostProperties block is replaced, the results are copied
+            if not copy_until_tag(source, buf, out, b'<HostProperties'):
+                raise Exception('Unable to find HostProperties for {}'.format(report_name))
+            props_start = read_until(source, buf, b'>')
+            if buf[props_start - 1:props_start] == b'/':
+                props_end = props_start + 1
+                text = b''
+            else:
+                props_end = read_until(source, buf, b'</HostProperties>', props_start)
+                if props_end < 0:
+                    raise Exception('Unable to find the end of HostProperties.')
+                text = bytes(buf[props_start + 1:props_end]).split(b'<')[0]
+                props_end += len(b'</HostProperties>')
+            del buf[:props_end]
+
+            parts = []
+            for tag in get_host_tags(values['hosts'][report_host_name], start, end):
+                write_nessus_element(tag, parts.append)
+            out.write(b'<HostProperties>' + text)
+            out.write(''.join(parts).encode('ascii', 'xmlcharrefreplace'))
+            out.write(b'</HostProperties>')
 
-    nessus_content = sanitize_xml_to_nessus(new_content)
+    except Exception as e:
+        display('ERROR: splice_values_to_nessus(): {}'.format(e), exit=1)
+        sys.exit(1)
+
+
+def serialize_nessus(tree):
+    parts = ['<?xml version="1.0" ?>\n']
+    write_nessus_element(tree, parts.append)
+
+    # characters outside ascii are written as character references
+    return ''.join(parts).encode('ascii', 'xmlcharrefreplace').decode('ascii')
+
+
+def write_nessus_element(elem, write):
+    tag = get_nessus_name(elem.tag)
+    write('<' + tag)
+    for (key, value) in elem.items():
+        write(' {}="{}"'.format(get_nessus_name(key), escape_nessus_attrib(value)))
+    # the cm prefix is declared on the Report element, as Nessus does
+    if tag == 'Report':
+        for uri in namespaces:
+            write(' xmlns:{}="{}"'.format(namespaces[uri], uri))
+    write('>')
+
+    if elem.text:
+        write(escape_nessus_text(elem.text))
+    for child in elem:
+        write_nessus_element(child, write)
+
+    write('</' + tag + '>')
+    if elem.tail:
+        write(escape_nessus_text(elem.tail))
+
+
+def get_nessus_name(name):
+    if name[:1] == '{':
+        (uri, local) = name[1:].split('}', 1)
+        if uri not in namespaces:
+            raise Exception('Unknown namespace: {}'.format(uri))
+        return '{}:{}'.format(namespaces[uri], local)
+    return name
+
+
+def escape_nessus_text(text):
+    text = text.replace('&', '&amp;')
+    text = text.replace('<', '&lt;')
+    text = text.replace('>', '&gt;')
+    text = text.replace('\'', '&apos;')
+    return text.replace('"', '&quot;')
+
+
+def escape_nessus_attrib(text):
+    text = text.replace('&', '&amp;')
+    text = text.replace('<', '&lt;')
+    text = text.replace('>', '&gt;')
+    text = text.replace('"', '&quot;')
+    text = text.replace('\r', '&#13;')
+    text = text.replace('\n', '&#10;')
+    return text.replace('\t', '&#09;')
+
+
+def write_spliced_file(filename, source, values, overwrite=False, mapping=None):
+    if os.path.isfile(filename) and not overwrite:
+        display('ERROR: write_spliced_file(): file exists: {}'.format(filename), exit=1)
+
+    try:
+        display('Reading {}'.format(source), verbose=True)
+        display('Writing {}'.format(filename), verbose=True)
+        with open_input(source) as file_in:
+            with open(filename, 'wb') as file_out:
+                splice_values_to_nessus(file_in, file_out, values, mapping)
+    except BaseException as e:
+        # a partial file is not left behind to be imported
+        if os.path.isfile(filename):
+            os.remove(filename)
+        if not isinstance(e, Exception):
+            raise
+        display('ERROR: write_spliced_file(): writing file: {}: {}'.format(filename, e), exit=1)
+
+
+def set_worker(values, mapping, timestamp, verbose):
+    global show_time, show_verbose, worker_values, worker_mapping
+    show_time = timestamp
+    show_verbose = verbose
+    worker_values = values
+    worker_mapping = mapping
+
+
+def convert_offline_file(source, args):
+    global worker_values, worker_mapping
+    error = None
+
+    try:
+        display('Processing file: {}'.format(source))
+        filename = create_filename(source, args.filename)
+        if args.splice:
+            write_spliced_file(filename, source, worker_values, args.overwrite, worker_mapping)
+        else:
+            content = read_file(source)
+            output = apply_values_to_nessus(content, worker_values, worker_mapping)
+            write_file(filename, output, args.overwrite)
+    except SystemExit:
+        error = last_error
+    except Exception as e:
+        error = 'ERROR: convert_offline_file(): {}: {}'.format(source, e)
 
-    return nessus_content
+    return (source, error)
 
 
-# Warning!!! hackish starts here... really bad.
-def sanitize_xml_to_nessus(source):
-    content = source.decode('utf-8')
+def convert_offline_files(files, args, values, mapping=None):
+    if args.jobs == 1 or len(files) == 1:
+        set_worker(values, mapping, show_time, show_verbose)
+        return [convert_offline_file(source, args) for source in files]
 
-    # clean up xml
-    content = content.replace('\'1.0\' encoding=\'ascii\'', '"1.0" ')
-    content = content.replace(' xmlns:ns0="http://www.nessus.org/cm"', '')
-    content = content.replace('<ns0:', '<cm:')
-    content = content.replace('</ns0:', '</cm:')
+    # the template is sent to each worker once, and only file names after
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.jobs,
+            initializer=set_worker,
+            initargs=(values, mapping, show_time, show_verbose)) as executor:
+        futures = [executor.submit(convert_offline_file, source, args) for source in files]
+        return [future.result() for future in futures]
 
-    content = re.sub('<(Report name="[^"]*")>', '<\\1 xmlns:cm="http://www.nessus.org/cm">', content)
 
+def report_results(results):
+    failures = [r for r in results if r[1] is not None]
 
-    # clean up character encoding
-    finds = re.findall('>([^<]+)<', content)
-    for value in finds:
-        replace = value.replace('\'', '&apos;')
-        replace = replace.replace('"', '&quot;')
-        content = content.replace('>' + value + '<', '>' + replace + '<')
+    for (source, error) in failures:
+        display('FAILED: {}: {}'.format(source, error))
 
-    return content
+    if failures:
+        display('ERROR: {} of {} files failed'.format(len(failures), len(results)), exit=1)
 
 
 if __name__ == '__main__':
     args = parse_args(sys.argv[1:])
     display('Start')
     display('Reading template nessus file')
-    nessus = read_file(args.template)
-    display('Retrieving properties')
-    values = get_host_properties_from_nessus(nessus)
-    display('Reading offline nessus file')
-    content = read_file(args.nessus)
-    display('Applying values')
-    output = apply_values_to_nessus(content, values)
-    display('Outputing file')
-    filename = create_filename(args.nessus, args.filename)
-    write_file(filename, output, args.overwrite)
+    values = read_template(args.template)
+    mapping = None
+    if args.map:
+        mapping = read_mapping(args.map)
+    display('Applying values to {} offline nessus files'.format(len(args.nessus)))
+    results = convert_offline_files(args.nessus, args, values, mapping)
+    report_results(results)
     display('Done')
@@ -13,7 +13,8 @@ import sys
 regexes = {
   'vars': re.compile('^[ \t]*#[ \t]*<variable>.*?^[ \t]*#[ \t]*</variable>', re.M|re.S),
   'name': re.compile('^[ \t]*#[ \t]*<name>(.*?)</name>', re.M),
-  'dflt': re.compile('^[ \t]*#[ \t]*<default>(.*?)</default>', re.M)
+  'dflt': re.compile('^[ \t]*#[ \t]*<default>(.*?)</default>', re.M),
+  'field': re.compile('^[ \t]*([^ \t:]+)[ \t]*:')
 }
 
 show_verbose = False
@@ -135,42 +136,64 @@ def get_variables(content=None):
     return variables
 
 
+def make_token_pattern(variables):
+    # longer names first, so a name that starts with another is matched whole
+    names = sorted(map(re.escape, variables), key=len, reverse=True)
+    return re.compile('@(' + '|'.join(names) + ')@')
+
+
+def replace_tokens(line, variables, number=0, pattern=None):
+    msg = 'Replacing {} with "{}" at line {}.'
+    parts = []
+    last = 0
+
+    if not variables:
+        return line
+    if pattern is None:
+        pattern = make_token_pattern(variables)
+
+    for match in pattern.finditer(line):
+        var = match.group(1)
+        display(msg.format(match.group(0), variables[var], number),
+                verbose=True)
+        parts.append(line[last:match.start()])
+        parts.append(variables[var])
+        last = match.end()
+
+    parts.append(line[last:])
+
+    return ''.join(parts)
+
+
 def replace_variable_values(content, variables):
     lines = content.split('\n')
-    msg = 'Replacing {} with "{}" at line {}.'
-    old = []
+    old = {}
+
+    if not variables:
+        return content
+    pattern = make_token_pattern(variables)
 
     for i in range(len(lines)):
         line = lines[i]
         if '@' in line:
-            for var in variables:
-                name = '@{}@'.format(var)
-                if name in line and line.strip()[0] != '#':
-                    display(msg.format(name, variables[var], i + 1),
-                            verbose=True)
-                    line = line.replace(name, variables[var])
-
-                if name in line and line.strip()[0] == '#':
-                    parts = line.split('"')
-                    old.append({
-                        'name': var,
-                        'field': parts[3],
-                        'value': parts[1]
-                    })
-
+            if line.strip()[0] != '#':
+                line = replace_tokens(line, variables, i + 1, pattern)
+            else:
+                # a note of a prior replacement names the value and field
+                parts = line.split('"')
+                for var in dict.fromkeys(pattern.findall(line)):
+                    if len(parts) > 3:
+                        old.setdefault(parts[3], []).append({
+                            'name': var,
+                            'value': parts[1]
+                        })
 
         if len(old) > 0:
-            remove = []
-            for n in range(len(old)):
-                field = old[n]['field']
-                if re.match('^[ \t]*' + field + '[ \t]*:', line):
-                    old_val = old[n]['value']
-                    new_val = variables[old[n]['name']]
-                    line = line.replace(old_val, new_val)
-                    remove.append(n)
-
-            for r in sorted(remove, reverse=True):
-                del old[r]
+            match = regexes['field'].match(line)
+            if match and match.group(1) in old:
+                for entry in old.pop(match.group(1)):
+                    new_val = variables[entry['name']]
+                    line = line.replace(entry['value'], new_val)
 
         lines[i] = line
 
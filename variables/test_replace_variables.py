@@ -6,6 +6,7 @@ import pytest
 from replace_variables import parse_args
 from replace_variables import make_list
 from replace_variables import get_variables
+from replace_variables import replace_tokens
 from replace_variables import replace_variable_values
 
 # input/output methods are not tested
@@ -109,6 +110,30 @@ def test_get_variables_multiple_variables():
     }
 
 
+def test_replace_tokens_no_tokens():
+    assert replace_tokens('  info : "Test"', {'VAR_ONE': 'Value One'}) == '  info : "Test"'
+
+
+def test_replace_tokens_known_and_unknown():
+    line = '  info : "@VAR_ONE@ and @VAR_OTHER@ and @VAR_ONE@"'
+    test_values = {'VAR_ONE': 'Value One'}
+    expected = '  info : "Value One and @VAR_OTHER@ and Value One"'
+    assert replace_tokens(line, test_values) == expected
+
+
+def test_replace_tokens_values_are_not_replaced_again():
+    line = '  info : "@VAR_ONE@ @VAR_TWO@"'
+    test_values = {'VAR_ONE': '@VAR_TWO@', 'VAR_TWO': 'Value Two'}
+    assert replace_tokens(line, test_values) == '  info : "@VAR_TWO@ Value Two"'
+
+
+def test_replace_tokens_names_with_punctuation():
+    line = '  info : "@MIN-LEN@ and @ADMIN.USER@ and @ADMIN_USER@"'
+    test_values = {'MIN-LEN': '14', 'ADMIN.USER': 'root'}
+    expected = '  info : "14 and root and @ADMIN_USER@"'
+    assert replace_tokens(line, test_values) == expected
+
+
 def test_replace_variable_values_no_content_or_values():
     assert replace_variable_values('', {}) == ''
 
@@ -216,6 +241,31 @@ def test_replace_variable_values_prior_replaced_value_multilple_on_line():
     assert replace_variable_values(test_content, test_values) == expected
 
 
+def test_replace_variable_values_comment_without_note():
+    test_content = ('# Set @VAR_ONE@ in the header\n'
+                    '<custom_item>\n'
+                    '  info : "Test @VAR_ONE@ variable"\n'
+                    '</custom_item>')
+    test_values = { 'VAR_ONE': 'Value One' }
+    expected = test_content.replace('"Test @VAR_ONE@', '"Test Value One')
+    assert replace_variable_values(test_content, test_values) == expected
+
+
+def test_replace_variable_values_prior_replaced_value_other_field_first():
+    test_content = ('# Note: Variable @VAR_ONE@ replaced with "Other One" in '
+                    'field "solution".\n'
+                    '  info : "Test Other One variable"\n'
+                    '  solution : "Test Other One variable"\n'
+                    '  solution : "Test Other One variable"')
+    test_values = { 'VAR_ONE': 'Value One' }
+    expected = ('# Note: Variable @VAR_ONE@ replaced with "Other One" in '
+                'field "solution".\n'
+                '  info : "Test Other One variable"\n'
+                '  solution : "Test Value One variable"\n'
+                '  solution : "Test Other One variable"')
+    assert replace_variable_values(test_content, test_values) == expected
+
+
 if __name__ == '__main__':
     import pytest
     pytest.main(['-v', '.'])